@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+"""
+Load test for brain_server.py
+Runs the real server with local stand-ins for ollama, Google ASR and gTTS,
+then drives it with simulated walls over the real socket protocol. Reports
+turn latency percentiles, sessions/sec and server memory as the number of
+concurrent walls grows. Needs no network, microphone, GPU or Pi.
+
+Usage:
+    python benchmark_server.py                      # 1, 2, 4, 8, 16 walls
+    python benchmark_server.py --walls 1,8,32 --sessions 5 --llm-parallel 2
+    python benchmark_server.py --json results.json  # keep numbers to compare runs
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import wave
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# --- DEFAULTS ---
+WALL_LEVELS = "1,2,4,8,16"   # Concurrent walls, one server run per level
+SESSIONS_PER_WALL = 3        # PIR-to-goodbye visits each wall plays through
+TURNS_PER_SESSION = 3        # Questions per visit (the goodbye comes on top)
+BENCH_PORT = 5600
+SOCKET_TIMEOUT = 120         # A reply slower than this counts as an error
+
+UPLOAD_RATE = 16000
+UTTERANCE_SECONDS = 2.0      # Length of each simulated question
+FRAME_MS = 120               # Audio per AUDIO_FRAME, as on the Pi
+
+# Fake backends (seconds; sizes in tokens / bytes)
+LLM_FIRST_TOKEN = 0.35       # Prompt processing before the first token
+LLM_TOKEN_DELAY = 0.03       # Per generated token
+LLM_TOKENS = 40              # Reply length
+LLM_PARALLEL = 1             # Generations the fake GPU runs at once (others wait)
+LLM_LOAD = 0.0               # Loading the model into the GPU, paid by the first request
+ASR_DELAY = 0.4              # Google round trip
+ASR_CPU = 0.0                # Pure-Python work per utterance, to stand in for a CPU-bound Vosk
+TTS_DELAY = 0.25             # gTTS round trip per sentence
+TTS_BYTES_PER_CHAR = 200     # Roughly what gTTS MP3 at 24 kHz produces
+
+# The simulated wall writes what the visitor "says" at the start of the PCM;
+# the fake recognizer reads it back. No marker means silence.
+SAY_MARKER = b"SAY:"
+QUESTIONS = [
+    "hello green wall how are you today",
+    "what kind of plants live on you",
+    "how is your soil moisture right now",
+    "do you like the people who visit you",
+    "tell me something about photosynthesis",
+]
+GOODBYE = "okay bye"
+FAKES_ENV = "GREENWALL_BENCH_FAKES"  # Fake backend options handed to ASR worker processes
+FAKE_OPTIONS = ("llm_first_token", "llm_token_delay", "llm_tokens", "llm_parallel", "llm_load",
+                "asr_delay", "asr_cpu", "tts_delay", "tts_bytes_per_char")
+REPLY_WORDS = ("leaves roots sunlight water soil green breathe grow calm air moss "
+               "ferns light visitors quiet morning fresh living wall happy").split()
+
+# --- FAKE BACKENDS ---
+
+def fake_mp3(size):
+    """Bytes that look like MP3 frames; nothing on the server decodes them"""
+    frame = b"\xff\xfb\x90\x64" + bytes(413)
+    return (frame * (size // len(frame) + 1))[:size]
+
+def fake_reply(tokens):
+    words = []
+    for i in range(tokens):
+        word = random.choice(REPLY_WORDS)
+        words.append(word.capitalize() if i == 0 or words[-1].endswith(".") else word)
+        if i % 12 == 11 or i == tokens - 1:
+            words[-1] += "."
+    return [w + " " for w in words]
+
+def burn_cpu(seconds):
+    """Keeps this thread busy in Python (holding the GIL) for about seconds"""
+    end = time.thread_time() + seconds
+    n = 0
+    while time.thread_time() < end:
+        n += sum(i * i for i in range(1000))
+    return n
+
+def install_fake_backends(opts):
+    """Puts stand-ins for ollama, speech_recognition and gtts into sys.modules.
+
+    Must run before brain_server is imported. The real packages are shadowed
+    even if installed, so a benchmark never reaches the network.
+    """
+    gpu = threading.BoundedSemaphore(opts.llm_parallel)
+    loaded = threading.Lock()  # Held until the model has been loaded once
+    loaded.acquire()
+
+    def load_model():
+        if loaded.locked():
+            time.sleep(opts.llm_load)
+            try: loaded.release()
+            except RuntimeError: pass  # Another request finished loading first
+
+    def chat(model=None, messages=None, stream=False, options=None, **kwargs):
+        tokens = fake_reply(min(opts.llm_tokens, (options or {}).get("num_predict", opts.llm_tokens)))
+        if not stream:
+            with gpu:
+                load_model()
+                time.sleep(opts.llm_first_token + opts.llm_token_delay * len(tokens))
+            return {'message': {'role': 'assistant', 'content': "".join(tokens)}}
+
+        def generate():
+            with gpu:  # Released when the stream is exhausted or closed early
+                load_model()
+                time.sleep(opts.llm_first_token)
+                for token in tokens:
+                    yield {'message': {'role': 'assistant', 'content': token}, 'done': False}
+                    time.sleep(opts.llm_token_delay)
+        return generate()
+
+    fake_ollama = types.ModuleType("ollama")
+    fake_ollama.chat = chat
+
+    class UnknownValueError(Exception):
+        pass
+
+    class RequestError(Exception):
+        pass
+
+    class AudioData:
+        def __init__(self, frame_data, sample_rate, sample_width):
+            self.frame_data = frame_data
+            self.sample_rate = sample_rate
+            self.sample_width = sample_width
+
+    class Recognizer:
+        def recognize_google(self, audio_data, show_all=False, **kwargs):
+            time.sleep(opts.asr_delay)
+            if opts.asr_cpu: burn_cpu(opts.asr_cpu)
+            data = bytes(audio_data.frame_data[:256])
+            if not data.startswith(SAY_MARKER):
+                raise UnknownValueError()
+            text = data[len(SAY_MARKER):].split(b"\0", 1)[0].decode()
+            if not show_all: return text
+            return {'alternative': [{'transcript': text, 'confidence': 0.92}], 'final': True}
+
+    fake_sr = types.ModuleType("speech_recognition")
+    fake_sr.AudioData = AudioData
+    fake_sr.Recognizer = Recognizer
+    fake_sr.UnknownValueError = UnknownValueError
+    fake_sr.RequestError = RequestError
+
+    class gTTS:
+        def __init__(self, text, lang='en', **kwargs):
+            self.text = text
+
+        def write_to_fp(self, fp):
+            time.sleep(opts.tts_delay)
+            fp.write(fake_mp3(len(self.text) * opts.tts_bytes_per_char))
+
+        def save(self, path):
+            with open(path, "wb") as f:
+                self.write_to_fp(f)
+
+    fake_gtts = types.ModuleType("gtts")
+    fake_gtts.gTTS = gTTS
+
+    sys.modules.update({"ollama": fake_ollama, "speech_recognition": fake_sr, "gtts": fake_gtts})
+
+# ASR worker processes (--asr-pool process) are spawned with this file as their
+# main module; they need the same stand-ins before brain_server is imported.
+if __name__ == "__mp_main__" and FAKES_ENV in os.environ:
+    install_fake_backends(types.SimpleNamespace(**json.loads(os.environ[FAKES_ENV])))
+
+def serve(opts):
+    """Server process: brain_server.start_server() on the fake backends"""
+    install_fake_backends(opts)
+    os.environ[FAKES_ENV] = json.dumps({name: getattr(opts, name) for name in FAKE_OPTIONS})
+    workdir = tempfile.mkdtemp(prefix="greenwall_bench_")
+    os.chdir(workdir)  # Fresh TTS cache per run, and nothing written into the repo
+    sys.path.insert(0, HERE)
+    import brain_server
+    brain_server.HOST_IP = "127.0.0.1"
+    brain_server.PORT = opts.port
+    brain_server.STATS_PORT = None
+    brain_server.TTS_PREWARM = opts.prewarm
+    brain_server.STREAM_REPLIES = not opts.no_stream
+    brain_server.SPECULATE_INTRO = not opts.no_speculate
+    if opts.no_answer_cache: brain_server.ANSWER_CACHE.size = 0
+    # Stage pools are built at import; rebuild them at the requested sizes
+    brain_server.ASR_STAGE = brain_server.Stage("asr", opts.asr_workers, kind=opts.asr_pool,
+                                                initializer=brain_server.load_asr)
+    brain_server.TTS_STAGE = brain_server.Stage("tts", opts.tts_workers)
+    brain_server.LLM_SCHEDULER = brain_server.LLMScheduler(opts.llm_concurrency)
+    brain_server.LLM_SLO_SECONDS = opts.llm_slo
+    brain_server.STAGES = (brain_server.ASR_STAGE, brain_server.TTS_STAGE, brain_server.ENCODE_STAGE)
+    try:
+        brain_server.start_server()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# --- FRAMING (blocking, same wire format as the Pi) ---
+
+def send_packet(sock, msg_type, payload=None, data=None, trace=None):
+    header = {"type": msg_type, "file_size": len(data) if data else 0, "payload": payload or {}}
+    if trace: header['trace'] = trace
+    header_bytes = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(header_bytes)) + header_bytes + (data or b""))
+
+def recvall(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        count = sock.recv_into(view[got:], n - got)
+        if not count: raise ConnectionError("server closed the connection")
+        got += count
+    return buf
+
+def receive_packet(sock):
+    header_len = struct.unpack('>I', recvall(sock, 4))[0]
+    header = json.loads(recvall(sock, header_len).decode('utf-8'))
+    if header.get('file_size', 0) > 0:
+        header['data'] = recvall(sock, header['file_size'])
+    return header
+
+# --- SIMULATED WALL ---
+
+def utterance_pcm(text, seconds):
+    """16-bit mono PCM carrying text for the fake recognizer, padded to length"""
+    size = int(UPLOAD_RATE * seconds) * 2
+    marked = SAY_MARKER + text.encode() + b"\0"
+    return marked + bytes(max(0, size - len(marked)))
+
+def wav_bytes(pcm):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(UPLOAD_RATE)
+        w.writeframes(pcm)
+    return buf.getvalue()
+
+class SimulatedWall:
+    """One wall on one connection, playing through visits like pi_greenwall_client.
+
+    Replies are not played back, so the server sees a visitor who answers
+    instantly: the worst case for throughput.
+    """
+
+    def __init__(self, index, opts):
+        self.index = index
+        self.opts = opts
+        self.sock = None
+        self.soil = 45
+        self.intro = []        # PIR_TRIGGER -> first intro audio
+        self.greeting = []     # USER_ENTER -> greeting audio
+        self.first_audio = []  # End of upload -> first reply audio
+        self.reply = []        # End of upload -> whole reply received
+        self.sessions = 0
+        self.turns = 0
+        self.error = None
+        self.ready = threading.Event()  # Connected and the server has warmed up
+
+    def connect(self):
+        self.sock = socket.create_connection(("127.0.0.1", self.opts.port), timeout=SOCKET_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_packet(self.sock, "HELLO", payload={"uplink": ["pcm"], "downlink": ["mp3"], "ready": True,
+                                                  "wall_id": f"bench-{self.index}"})
+        if not self.expect("HELLO_ACK")['payload'].get('ready'):
+            self.expect("READY")
+
+    def push_soil(self):
+        send_packet(self.sock, "SOIL_DATA", payload={"soil": self.soil})
+
+    def expect(self, *types):
+        """Reads until a packet of one of types arrives, answering GET_SOIL on the way"""
+        while True:
+            msg = receive_packet(self.sock)
+            if msg['type'] in types: return msg
+            if msg['type'] in ("GET_SOIL", "SUBSCRIBE_SOIL"):
+                self.push_soil()
+
+    def upload(self, text):
+        """Sends one utterance the way the Pi does; returns when the last byte is out"""
+        pcm = utterance_pcm(text, self.opts.utterance_seconds)
+        trace = os.urandom(8).hex()
+        if self.opts.upload == "wav":
+            send_packet(self.sock, "AUDIO", payload={"codec": "wav", "speech": True},
+                        data=wav_bytes(pcm), trace=trace)
+            return
+        frame_bytes = UPLOAD_RATE * FRAME_MS // 1000 * 2
+        for seq, start in enumerate(range(0, len(pcm), frame_bytes)):
+            send_packet(self.sock, "AUDIO_FRAME", payload={"seq": seq, "codec": "pcm"},
+                        data=pcm[start:start + frame_bytes], trace=trace)
+            if self.opts.realtime:
+                time.sleep(FRAME_MS / 1000)
+        send_packet(self.sock, "AUDIO_END", payload={"speech": True, "rate": UPLOAD_RATE, "codec": "pcm"},
+                    trace=trace)
+
+    def wait_reply(self, sent):
+        """Times one reply: a single SPEAK, or SPEAK_CHUNKs up to the final marker"""
+        first = None
+        while True:
+            msg = self.expect("SPEAK", "SPEAK_CHUNK")
+            if first is None and msg.get('file_size', 0) > 0:
+                first = time.monotonic()
+                self.first_audio.append(first - sent)
+            if msg['type'] == "SPEAK" or msg.get('payload', {}).get('final'):
+                self.reply.append(time.monotonic() - sent)
+                return
+
+    def visit(self, number):
+        # Alternate wet and dry walls so both intro paths and the soil re-check run
+        self.soil = 22 if number % 2 else 45
+        self.push_soil()
+        start = time.monotonic()
+        send_packet(self.sock, "PIR_TRIGGER", payload={"soil": self.soil}, trace=os.urandom(8).hex())
+        self.expect("SPEAK_INTRO")
+        self.intro.append(time.monotonic() - start)
+
+        if self.opts.intro_listen:
+            time.sleep(self.opts.intro_listen / 2)
+            if self.soil < 30 and number % 4 == 1:
+                self.soil = 38  # The visitor waters the wall while the intro plays
+                self.push_soil()
+            time.sleep(self.opts.intro_listen / 2)
+        send_packet(self.sock, "USER_ENTER")
+        entered = time.monotonic()
+        self.expect("SPEAK")  # Greeting; the Pi would start recording now
+        self.greeting.append(time.monotonic() - entered)
+        for turn in range(self.opts.turns):
+            self.push_soil()
+            self.upload(QUESTIONS[(self.index + number + turn) % len(QUESTIONS)])
+            self.wait_reply(time.monotonic())
+            self.turns += 1
+            if self.opts.think_time: time.sleep(self.opts.think_time)
+        self.upload(GOODBYE)
+        self.expect("END_SESSION")
+        self.sessions += 1
+
+    def run(self, go):
+        try:
+            self.connect()
+            self.ready.set()
+            go.wait()
+            for number in range(self.opts.sessions):
+                self.visit(number)
+        except (OSError, ValueError, struct.error) as e:
+            self.error = f"wall {self.index}: {e}"
+        finally:
+            self.ready.set()
+            if self.sock: self.sock.close()
+
+# --- RUNNER ---
+
+def percentile(values, q):
+    """Nearest-rank percentile (same as the server's /stats)"""
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+def proc_status(pid):
+    """VmHWM / VmRSS (MB) and thread count of a process from /proc"""
+    info = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmHWM", "VmRSS"):
+                    info[key] = int(value.split()[0]) / 1024
+                elif key == "Threads":
+                    info[key] = int(value)
+    except OSError: pass
+    return info
+
+def server_command(opts):
+    cmd = [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(opts.port)]
+    for name in FAKE_OPTIONS + ("asr_workers", "asr_pool", "tts_workers", "llm_concurrency", "llm_slo"):
+        cmd += ["--" + name.replace("_", "-"), str(getattr(opts, name))]
+    if opts.prewarm: cmd.append("--prewarm")
+    if opts.no_stream: cmd.append("--no-stream")
+    if opts.no_answer_cache: cmd.append("--no-answer-cache")
+    if opts.no_speculate: cmd.append("--no-speculate")
+    return cmd
+
+def wait_for_port(port, proc, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start listening")
+
+def server_stats(port):
+    """The server's own stage percentiles and worker pool usage (GET_STATS)"""
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+            send_packet(sock, "HELLO", payload={"uplink": ["pcm"], "downlink": ["mp3"]})
+            send_packet(sock, "GET_STATS")
+            while True:
+                msg = receive_packet(sock)
+                if msg['type'] == "STATS": return msg['payload']
+    except (OSError, ValueError, struct.error):
+        return {}
+
+def run_level(walls, opts, log):
+    """Starts a fresh server, runs `walls` simulated walls against it, and shuts it down"""
+    launched = time.monotonic()
+    proc = subprocess.Popen(server_command(opts), stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(opts.port, proc)
+        listening = time.monotonic() - launched
+        peak = {}
+        done = threading.Event()
+
+        def sample():
+            # VmHWM already is the peak; threads are sampled at their busiest
+            while not done.wait(0.25):
+                status = proc_status(proc.pid)
+                peak['threads'] = max(peak.get('threads', 0), status.get('Threads', 0))
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+
+        go = threading.Event()
+        sims = [SimulatedWall(i, opts) for i in range(walls)]
+        threads = [threading.Thread(target=sim.run, args=(go,), daemon=True) for sim in sims]
+        for t in threads: t.start()
+        for sim in sims: sim.ready.wait()  # Every wall through HELLO and READY before the clock starts
+        ready = time.monotonic() - launched
+        start = time.monotonic()
+        go.set()
+        for t in threads: t.join()
+        elapsed = time.monotonic() - start
+        done.set()
+        sampler.join()
+
+        status = proc_status(proc.pid)
+        result = {
+            "walls": walls,
+            "elapsed": elapsed,
+            "sessions": sum(s.sessions for s in sims),
+            "turns": sum(s.turns for s in sims),
+            "errors": [s.error for s in sims if s.error],
+            "rss_peak_mb": status.get('VmHWM'),
+            "rss_end_mb": status.get('VmRSS'),
+            "threads_peak": peak.get('threads'),
+            "startup": {"listening": listening, "ready": ready},
+        }
+        stats = server_stats(opts.port)
+        result["server_stages"] = stats.get('stages', {})
+        result["server_pools"] = stats.get('pools', {})
+        for name in ("intro", "greeting", "first_audio", "reply"):
+            values = [v for s in sims for v in getattr(s, name)]
+            result[name] = {f"p{int(q * 100)}": percentile(values, q) for q in (0.5, 0.95, 0.99)}
+        result["sessions_per_sec"] = result["sessions"] / elapsed if elapsed else 0.0
+        return result
+    finally:
+        # SIGINT is the server's Ctrl+C: it closes the walls and exits cleanly
+        proc.send_signal(signal.SIGINT)
+        try: proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+def ms(value):
+    return "-" if value is None else f"{value * 1000:.0f}"
+
+def mb(value):
+    return "-" if value is None else f"{value:.1f}"
+
+def print_header():
+    print(f"{'walls':>5} {'sessions':>8} {'sess/s':>7} {'turns':>5}  "
+          f"{'first audio ms p50/p95/p99':>26}  {'reply ms p50/p95/p99':>22}  "
+          f"{'intro p50':>9} {'greet p50':>9} {'rss MB':>7} {'threads':>7} {'errors':>6}")
+
+def print_result(r):
+    fa, rep = r['first_audio'], r['reply']
+    print(f"{r['walls']:>5} {r['sessions']:>8} {r['sessions_per_sec']:>7.2f} {r['turns']:>5}  "
+          f"{ms(fa['p50']) + '/' + ms(fa['p95']) + '/' + ms(fa['p99']):>26}  "
+          f"{ms(rep['p50']) + '/' + ms(rep['p95']) + '/' + ms(rep['p99']):>22}  "
+          f"{ms(r['intro']['p50']):>9} {ms(r['greeting']['p50']):>9} {mb(r['rss_peak_mb']):>7} {r['threads_peak'] or '-':>7} "
+          f"{len(r['errors']):>6}")
+
+def print_stages(r, names=("asr", "llm_first_token", "llm_total", "tts", "send")):
+    stages = r['server_stages']
+    parts = [f"{n} {ms(stages[n].get('p95'))}" for n in names if n in stages]
+    if parts:
+        print(f"{'':>5}   server p95 ms: " + ", ".join(parts))
+    startup = r.get('startup')
+    if startup:
+        print(f"{'':>5}   startup: listening after {startup['listening']:.1f}s, "
+              f"all walls ready after {startup['ready']:.1f}s")
+    pools = r.get('server_pools', {})
+    if pools:
+        queue_p95 = {n: stages.get(f"{n}_queue", {}).get('p95') for n in pools}
+        print(f"{'':>5}   pools: " + ", ".join(
+            f"{n} {p['workers']}x{p['kind']} {p['utilization'] * 100:.0f}% busy (queue p95 {ms(queue_p95[n])} ms)"
+            + (f", {p['shed']} shed" if p.get('shed') else "")
+            for n, p in pools.items()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for brain_server.py with fake ollama, ASR and TTS")
+    parser.add_argument("--walls", default=WALL_LEVELS, help="comma-separated concurrent wall counts")
+    parser.add_argument("--sessions", type=int, default=SESSIONS_PER_WALL, help="visits per wall")
+    parser.add_argument("--turns", type=int, default=TURNS_PER_SESSION, help="questions per visit")
+    parser.add_argument("--port", type=int, default=BENCH_PORT)
+    parser.add_argument("--upload", choices=("stream", "wav"), default="stream",
+                        help="AUDIO_FRAME stream (current Pi) or one AUDIO WAV (older Pi)")
+    parser.add_argument("--utterance-seconds", type=float, default=UTTERANCE_SECONDS)
+    parser.add_argument("--realtime", action="store_true", help="pace uploaded frames like a live microphone")
+    parser.add_argument("--think-time", type=float, default=0.0, help="pause between turns (seconds)")
+    parser.add_argument("--intro-listen", type=float, default=0.0,
+                        help="seconds the visitor listens to the intro before Enter (some dry walls get watered)")
+    parser.add_argument("--prewarm", action="store_true", help="let the server pre-warm its TTS cache")
+    parser.add_argument("--no-stream", action="store_true", help="server sends whole replies (STREAM_REPLIES off)")
+    parser.add_argument("--no-answer-cache", action="store_true", help="server answers every question with the LLM")
+    parser.add_argument("--no-speculate", action="store_true", help="server does nothing while the intro plays")
+    parser.add_argument("--asr-workers", type=int, default=2, help="server ASR_WORKERS")
+    parser.add_argument("--asr-pool", choices=("thread", "process"), default="thread", help="server ASR_POOL")
+    parser.add_argument("--tts-workers", type=int, default=4, help="server TTS_WORKERS")
+    parser.add_argument("--llm-concurrency", type=int, default=1, help="server LLM_MAX_CONCURRENT")
+    parser.add_argument("--llm-slo", type=float, default=8.0, help="server LLM_SLO_SECONDS")
+    parser.add_argument("--server-log", default=os.devnull, help="where the server's console output goes")
+    parser.add_argument("--json", help="also write the results to this file")
+
+    fakes = parser.add_argument_group("fake backends")
+    fakes.add_argument("--llm-first-token", type=float, default=LLM_FIRST_TOKEN)
+    fakes.add_argument("--llm-token-delay", type=float, default=LLM_TOKEN_DELAY)
+    fakes.add_argument("--llm-tokens", type=int, default=LLM_TOKENS)
+    fakes.add_argument("--llm-parallel", type=int, default=LLM_PARALLEL)
+    fakes.add_argument("--llm-load", type=float, default=LLM_LOAD)
+    fakes.add_argument("--asr-delay", type=float, default=ASR_DELAY)
+    fakes.add_argument("--asr-cpu", type=float, default=ASR_CPU)
+    fakes.add_argument("--tts-delay", type=float, default=TTS_DELAY)
+    fakes.add_argument("--tts-bytes-per-char", type=int, default=TTS_BYTES_PER_CHAR)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.serve:
+        serve(opts)
+        return
+
+    levels = [int(w) for w in opts.walls.split(",") if w.strip()]
+    print(f"Fake backends: LLM {opts.llm_first_token}s + {opts.llm_tokens} x {opts.llm_token_delay}s "
+          f"({opts.llm_parallel} at a time), ASR {opts.asr_delay}s, TTS {opts.tts_delay}s")
+    print(f"Each wall: {opts.sessions} visits x {opts.turns} turns, {opts.upload} upload\n")
+    print_header()
+    results = []
+    with open(opts.server_log, "a") as log:
+        for walls in levels:
+            result = run_level(walls, opts, log)
+            results.append(result)
+            print_result(result)
+            print_stages(result)
+            for error in result['errors']:
+                print(f"{'':>5}   ! {error}")
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump({"options": vars(opts), "results": results}, f, indent=1)
+        print(f"\nSaved to {opts.json}")
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,457 @@
 import socket
 import json
+import math
+import mmap
 import os
 import struct
 import time
 import re
-import speech_recognition as sr
-import ollama 
-from gtts import gTTS
+import io
+import hashlib
+import hmac
+import multiprocessing
+import queue
+import random
+import secrets
+import select
+import shutil
+import subprocess
+import threading
+import wave
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# speech_recognition, ollama and gtts are imported where they are first used,
+# so the server is listening before the slow libraries have loaded
+
+PROCESS_START = time.time()
 
 # --- CONFIGURATION ---
 HOST_IP = '10.32.38.101'
 PORT = 5000
+MAX_WALLS = 32          # Concurrent wall sessions served by the worker pool
+CHUNK_SIZE = 64 * 1024  # Socket read size when streaming packet bodies
+SOCKET_TIMEOUT = 30     # A wall that stalls mid-packet or stops reading for this long is dropped
+PACKET_QUEUE_LIMIT = 64 # Unclaimed packets kept per message type (oldest dropped)
+BINARY_HEADERS = True   # Accept the wall's offer of struct-packed headers (JSON is always understood)
+
+# Session resume (walls that reconnect after a network drop carry on where they were)
+RESUME_GRACE = 45                      # Seconds a dropped wall's session is kept for it
+RESUME_BUFFER_BYTES = 8 * 1024 * 1024  # Audio the wall has not acknowledged yet, kept for replay
+RESUMABLE_TYPES = ("SPEAK_INTRO", "SPEAK", "SPEAK_CHUNK", "END_SESSION")  # Numbered and replayed
+
+# Session timeouts (seconds)
+ENTER_TIMEOUT = 40
+REMINDER_TIMEOUT = 30
+CHAT_TIMEOUT = 60
+SOIL_TIMEOUT = 5
+
+# Soil telemetry pushed by the client (SUBSCRIBE_SOIL)
+SOIL_PUSH_INTERVAL = 5   # Seconds between routine SOIL_DATA pushes
+SOIL_PUSH_DELTA = 2      # A change of this many percent is pushed at once
+SOIL_FRESHNESS = 15      # Older cached readings fall back to a GET_SOIL request
+
+DEBUG_AUDIO_FILES = False  # Also save each session's input/reply audio to disk
+
+SOIL_DRY_THRESHOLD = 30  # Below this percentage the wall asks for water
+
+# Fleet soil telemetry: every wall's readings, and when each will be dry (see FLEET TELEMETRY)
+TELEMETRY_DIR = "telemetry"     # One memory-mapped file per column
+TELEMETRY_CAPACITY = 1 << 20    # Rows kept (14 bytes each); the oldest half goes when it is full
+TELEMETRY_MIN_INTERVAL = 60     # An unchanged reading from a wall is logged at most this often (seconds)
+FORECAST_INTERVAL = 300         # Seconds between fleet forecast runs
+FORECAST_BUCKET = 3600          # Rollup bucket (seconds) the drying rate is fitted on
+FORECAST_WINDOW = 48 * 3600     # History the fit looks at
+FORECAST_HORIZON = 24 * 3600    # "Dry by tomorrow"
+FORECAST_MIN_BUCKETS = 3        # Buckets since the last watering needed for a drying rate
+FORECAST_WATERING_JUMP = 5      # A rise of this many percent between buckets counts as a watering
+FORECAST_FLAT_SLOPE = 0.01      # Percent per hour; a smaller drying rate is rounding noise, not drying
+
+# Speech Recognition
+ASR_BACKEND = "google"  # "google" (remote, needs internet) or "vosk" (local, offline)
+VOSK_MODEL_PATH = "models/vosk-model-small-en-us-0.15"
+UPLOAD_SAMPLE_RATE = 16000  # Rate of streamed AUDIO_FRAME PCM from the client
+
+# LLM
+LLM_MODEL = 'gemma2:2b'
+STREAM_REPLIES = True   # Speak the reply sentence by sentence while it is generated
+THINKING_ERROR_TEXT = "I am having trouble thinking."
+LLM_KEEP_ALIVE = "30m"  # Keep the model and its prompt cache loaded between turns
+
+# LLM scheduling across walls (see LLM SCHEDULER)
+LLM_MAX_CONCURRENT = 1  # Generations sent to ollama at once (match OLLAMA_NUM_PARALLEL)
+LLM_SLO_SECONDS = 8     # A reply that would wait longer than this for the model gets a fallback
+LLM_BUSY_TEXTS = [
+    "So many visitors are talking to me right now. Could you ask me that again in a moment?",
+    "My leaves are rustling with questions from everyone. Please ask me once more in a little while.",
+]
+
+# Work done while the intro plays (see INTRO SPECULATION)
+SPECULATE_INTRO = True  # Synthesize the likely start messages and warm the model before Enter
+SPECULATE_POLL = 0.5    # Seconds between checks of the pushed soil reading for a new start message
+LLM_WARMUP_IDLE = 120   # Only warm the model up if no request has used it for this long
+
+# Worker stages shared by all walls (see WORKER STAGES)
+ASR_WORKERS = 2            # Utterances recognized at once
+ASR_POOL = "thread"        # "process" runs recognition in worker processes (CPU-bound Vosk); each loads the model
+TTS_WORKERS = 4            # Sentences synthesized in parallel
+ENCODE_WORKERS = os.cpu_count() or 2  # ffmpeg transcodes running at once
+STAGE_QUEUE_LIMIT = 32     # Jobs waiting per stage before callers are held back
+STAGE_WINDOW = 60          # Seconds of history behind the utilization figures
+
+# Conversation context
+CONTEXT_TOKEN_BUDGET = 1024  # Rough prompt size (tokens) before old turns get summarized
+CONTEXT_KEEP_MESSAGES = 6    # Most recent messages that are always sent word for word
+
+# TTS Cache
+TTS_LANG = 'en'
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+TTS_CACHE_DISK_BYTES = 512 * 1024 * 1024
+TTS_PREWARM = True  # Synthesize all fixed phrases in the background at startup
+
+# Answer cache (frequent visitor questions)
+ANSWER_CACHE_SIZE = 256        # Cached answers (text plus audio); 0 disables the cache
+ANSWER_CACHE_TTL = 6 * 3600    # Seconds before a cached answer is asked again
+ANSWER_MAX_WORDS = 8           # Only short, generic questions are cached
+ANSWER_MIN_SIMILARITY = 0.75   # Token-set overlap (Jaccard) that still counts as the same question
+ANSWER_REGENERATE_EVERY = 4    # Every Nth hit on an answer asks the LLM again for variety (0 = never)
+
+# Audio codecs (negotiated per wall in the HELLO handshake)
+FFMPEG_CMD = "ffmpeg"  # Needed for Opus/FLAC uploads and non-MP3 replies; without it only PCM up / MP3 down
+HELLO_TIMEOUT = 2      # Seconds to wait for a client's HELLO before assuming an old client
+STARTUP_TIMEOUT = 90   # Walls are told the server is ready after this even if a warm-up is still running
+TTS_PCM_RATE = 24000   # Sample rate of raw PCM replies (gTTS voices are 24 kHz)
+OPUS_BITRATE = "32k"
+
+# Latency tracing
+STATS_PORT = 9108       # Prometheus text at http://HOST_IP:9108/metrics (None disables)
+TRACE_SAMPLES = 2048    # Recent samples per stage kept for p50/p95/p99
+TRACE_LOG = True        # Print a one-line stage breakdown after every turn
 
 # --- TEXT TEMPLATES ---
 BASE_INTRO = "Welcome. I am a Vertical Living Green Wall. "
 PROMPT_TEXT = "Would you like to speak with me? Please press the Enter key to start."
 REMINDER_TEXT = "I am still waiting. Press Enter if you wish to speak."
 EXIT_TEXT = "I understand. Have a peaceful day."
+NO_SPEECH_TEXT = "I didn't hear anything. Please try again."
+READY_TEXT = "Great. I am ready."
+LISTENING_TEXT = " I am listening."
+DEFAULT_GREETING = "Hello! I am listening. Please speak now."
+
+SYSTEM_PROMPT = ("You are a sentient Vertical Green Wall and you are a living, "
+    "breathing plant and you are chatting with a human via voice. " 
+    "Keep your responses concise and friendly. " 
+    "also you can mention your need for water if your soil is dry." 
+    "you can refer to yourself as a plant wall or green wall.")
+SUMMARY_PROMPT = ("Summarize the conversation below between a visitor and a green wall "
+    "in at most three short sentences. Keep names, questions and promises. "
+    "Reply with the summary only.")
+
+def build_intro_text(soil):
+    intro = BASE_INTRO
+    if soil < SOIL_DRY_THRESHOLD:
+        intro += f"My soil moisture is low at {soil} percent. It is dry. Could you please help water me? "
+    else:
+        intro += f"My soil moisture is a healthy {soil} percent. I do not need water. "
+    return intro + PROMPT_TEXT
+
+def build_start_message(was_dry, soil):
+    """Message spoken after Enter, depending on the soil re-check"""
+    if not was_dry:
+        return READY_TEXT
+    if soil < SOIL_DRY_THRESHOLD:
+        return f"I see my soil is still dry at {soil} percent. Perhaps the water needs time to soak in. We can talk anyway."
+    return f"Thank you! I sense the water. My moisture is now {soil} percent. I feel much better."
+
+def template_phrases():
+    """Every phrase the wall can say without the LLM, for cache pre-warming"""
+    phrases = [PROMPT_TEXT, REMINDER_TEXT, EXIT_TEXT, NO_SPEECH_TEXT, DEFAULT_GREETING]
+    for soil in range(0, 101):
+        phrases.append(build_intro_text(soil))
+        phrases.append(build_start_message(True, soil) + LISTENING_TEXT)
+    phrases.append(build_start_message(False, 0) + LISTENING_TEXT)
+    return phrases
+
+# --- TTS CACHE ---
+
+class TTSCache:
+    """Content-addressed TTS cache: an LRU in memory backed by a directory on disk.
+
+    Keys are a hash of the cleaned text plus the voice settings, so the same
+    sentence is only ever synthesized once; the codec is the file extension,
+    so each reply format of a sentence is cached separately.
+    """
+
+    def __init__(self, directory, memory_bytes, disk_bytes):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(clean_text, lang=TTS_LANG, tld="com", codec="mp3"):
+        digest = hashlib.sha256(f"{lang}|{tld}|{clean_text}".encode('utf-8')).hexdigest()
+        return f"{digest}.{codec}"
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _remember(self, key, data):
+        # Caller holds the lock
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = data
+        self.memory_used += len(data)
+        while self.memory_used > self.memory_bytes and len(self.memory) > 1:
+            _, old = self.memory.popitem(last=False)
+            self.memory_used -= len(old)
+
+    def get(self, key, count=True):
+        """Cached audio or None; count=False leaves the hit/miss counters alone (preloading)"""
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                if count: self.hits += 1
+                return data
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # Disk eviction is least-recently-used by mtime
+        except OSError:
+            if count:
+                with self.lock: self.misses += 1
+            return None
+        with self.lock:
+            self._remember(key, data)
+            if count: self.hits += 1
+        return data
+
+    def contains(self, key):
+        with self.lock:
+            if key in self.memory: return True
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data):
+        with self.lock:
+            self._remember(key, data)
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[TTS] Cache write failed: {e}")
+            return
+        self._evict_disk()
+
+    def discard(self, key):
+        """Forgets an entry that will not be needed (memory and disk)"""
+        with self.lock:
+            data = self.memory.pop(key, None)
+            if data is not None: self.memory_used -= len(data)
+        try: os.remove(self._path(key))
+        except OSError: pass
+
+    def _evict_disk(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if not e.name.endswith(".tmp")]
+        except OSError: return
+        total = sum(e.stat().st_size for e in entries)
+        if total <= self.disk_bytes: return
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except OSError: pass
+            if total <= self.disk_bytes: break
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "memory_entries": len(self.memory), "memory_bytes": self.memory_used}
+
+TTS_CACHE = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MEMORY_BYTES, TTS_CACHE_DISK_BYTES)
+
+# --- ANSWER CACHE ---
+
+# Words that do not change what a visitor is asking
+FILLER_WORDS = frozenset("""a an the um uh er hmm so well please hey hi hello okay ok oh
+    just like you your you're green wall plant dear""".split())
+
+def question_tokens(text):
+    """Normalized token set of a transcript, e.g. 'How are you?' -> {how, are}"""
+    return frozenset(re.findall(r"[a-z0-9']+", text.lower())) - FILLER_WORDS
+
+def soil_bucket(soil):
+    """The soil state an answer depends on; None while no reading has arrived"""
+    if soil is None: return None
+    return "dry" if soil < SOIL_DRY_THRESHOLD else "ok"
+
+class AnswerEntry:
+    def __init__(self, text):
+        self.text = text
+        self.audio = {}  # codec -> (data, codec metadata)
+        self.created = time.time()
+        self.hits = 0
+
+class AnswerCache:
+    """Replies to frequent questions, keyed by soil state and normalized transcript.
+
+    An exact token-set match is a dict lookup; otherwise the most similar
+    question with the same soil state is used if the overlap is high enough.
+    Entries keep the reply text and its audio per downlink codec, expire
+    after a TTL and are evicted least-recently-used. Every Nth hit on an
+    entry is reported as a miss so the LLM writes a fresh reply.
+    """
+
+    def __init__(self, size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, regenerate_every=ANSWER_REGENERATE_EVERY):
+        self.size = size
+        self.ttl = ttl
+        self.regenerate_every = regenerate_every
+        self.entries = OrderedDict()  # (bucket, tokens) -> AnswerEntry
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, question, bucket):
+        tokens = question_tokens(question)
+        if not self.size or bucket is None or not tokens or len(tokens) > ANSWER_MAX_WORDS: return None
+        return (bucket, tokens)
+
+    def _find(self, key):
+        # Caller holds the lock
+        now = time.time()
+        for old in [k for k, e in self.entries.items() if now - e.created > self.ttl]:
+            del self.entries[old]
+        if key in self.entries: return key
+        bucket, tokens = key
+        best, best_score = None, ANSWER_MIN_SIMILARITY
+        for other in self.entries:
+            if other[0] != bucket: continue
+            score = len(tokens & other[1]) / len(tokens | other[1])
+            if score >= best_score: best, best_score = other, score
+        return best
+
+    def lookup(self, question, bucket):
+        """The cached entry for question, or None if the LLM has to answer"""
+        key = self.key(question, bucket)
+        if key is None: return None
+        with self.lock:
+            found = self._find(key)
+            if found is None:
+                self.misses += 1
+                return None
+            entry = self.entries[found]
+            self.entries.move_to_end(found)
+            entry.hits += 1
+            if self.regenerate_every and entry.hits % self.regenerate_every == 0:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def peek(self, question, bucket):
+        """The closest cached entry, without counting a hit or asking for a fresh reply"""
+        key = self.key(question, bucket)
+        if key is None: return None
+        with self.lock:
+            found = self._find(key)
+            return self.entries[found] if found is not None else None
+
+    def store(self, question, bucket, text):
+        """Caches a reply (replacing a regenerated one); returns its entry or None"""
+        key = self.key(question, bucket)
+        if key is None or not text: return None
+        with self.lock:
+            found = self._find(key) or key
+            entry = AnswerEntry(text)
+            old = self.entries.pop(found, None)
+            if old: entry.hits = old.hits
+            self.entries[found] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "entries": len(self.entries)}
+
+ANSWER_CACHE = AnswerCache()
+
+def cache_answer_audio(entry, codec):
+    """Synthesizes a cached answer in codec (a TTS stage job)"""
+    if codec in entry.audio: return
+    data, meta = generate_tts(entry.text, codec)
+    if data: entry.audio[codec] = (data, meta)
+
+def remember_answer(session, question, text):
+    """Caches a complete reply and renders its audio on the TTS stage"""
+    if session.cancelled.is_set() or session.fallback: return
+    entry = ANSWER_CACHE.store(question, soil_bucket(session.soil), text)
+    if entry: TTS_STAGE.submit(cache_answer_audio, entry, session.downlink)
+
+def speak_cached_answer(session, entry):
+    session.log(f"Wall (cached, hit {entry.hits}): {entry.text}")
+    if session.downlink not in entry.audio:
+        TTS_STAGE.run(cache_answer_audio, entry, session.downlink)
+    data, meta = entry.audio.get(session.downlink, (None, {}))
+    session.send("SPEAK", payload={"turn": session.turn, **meta}, data=data)
+
+def render_tts(clean_text):
+    from gtts import gTTS
+    buf = io.BytesIO()
+    gTTS(text=clean_text, lang=TTS_LANG).write_to_fp(buf)
+    return buf.getvalue()
+
+def synthesize(clean_text, codec="mp3"):
+    """Returns audio for already-cleaned text in codec, using the cache when possible"""
+    key = TTSCache.key(clean_text, codec=codec)
+    data = TTS_CACHE.get(key)
+    if data is None:
+        if codec == "mp3":
+            data = render_tts(clean_text)
+        else:
+            data = encode_reply(synthesize(clean_text), codec)
+        TTS_CACHE.put(key, data)
+    return data
+
+def prewarm_tts_cache(phrases=None):
+    """Synthesizes the template phrases that are not cached yet"""
+    phrases = phrases or template_phrases()
+    start = time.time()
+    made = 0
+    for text in phrases:
+        clean_text = clean_text_for_audio(text)
+        key = TTSCache.key(clean_text)
+        if TTS_CACHE.contains(key): continue
+        try:
+            TTS_CACHE.put(key, render_tts(clean_text))
+            made += 1
+        except Exception as e:
+            print(f"[TTS] Pre-warm failed: {e}")
+            return
+    print(f"[TTS] Cache warm: {len(phrases)} phrases ({made} new) in {time.time() - start:.1f}s")
 
 # --- HELPER FUNCTIONS ---
 
-def generate_tts(text, filename="reply.mp3"):
+def generate_tts(text, codec="mp3"):
+    """Returns (audio, codec metadata) for text, or (None, {}) if synthesis failed"""
     # --- CLEAN THE TEXT FIRST ---
     clean_text = clean_text_for_audio(text)
     
@@ -28,64 +459,439 @@ def generate_tts(text, filename="reply.mp3"):
     print(f"[TTS] Speaking: {clean_text[:30]}...")
     
     try:
-        # Generate audio from the CLEAN text
-        tts = gTTS(text=clean_text, lang='en')
-        tts.save(filename)
-        return filename
+        # Generate audio from the CLEAN text (or reuse a cached copy)
+        try:
+            return synthesize(clean_text, codec), codec_metadata(codec)
+        except TranscodeError as e:
+            # MP3 is the baseline every client can play
+            print(f"[CODEC] {e}; sending MP3 instead")
+            return synthesize(clean_text), codec_metadata("mp3")
     except Exception as e:
         print(f"TTS Error: {e}")
-        return None
+        return None, {}
+
+# --- AUDIO CODECS ---
+# Raw PCM and WAV uploads and MP3 replies need nothing extra. Opus/FLAC uploads
+# and PCM/Opus replies are transcoded by ffmpeg, and are only offered in the
+# handshake when ffmpeg is installed.
+
+# ffmpeg arguments that describe each format on a pipe
+CODEC_INPUT_ARGS = {"opus": ["-f", "ogg"], "flac": ["-f", "flac"], "mp3": ["-f", "mp3"]}
+CODEC_OUTPUT_ARGS = {
+    "pcm": ["-f", "s16le", "-ac", "1", "-ar", str(TTS_PCM_RATE)],
+    "opus": ["-c:a", "libopus", "-b:a", OPUS_BITRATE, "-f", "ogg"],
+}
+
+class TranscodeError(Exception):
+    pass
+
+def ffmpeg_available():
+    return shutil.which(FFMPEG_CMD) is not None
+
+def server_codecs():
+    """Formats this server accepts from walls (uplink) and can send (downlink)"""
+    uplink, downlink = ["pcm", "wav"], ["mp3"]
+    if ffmpeg_available():
+        uplink += ["opus", "flac"]
+        downlink += ["pcm", "opus"]
+    return {"uplink": uplink, "downlink": downlink}
+
+def negotiate_codec(offered, supported, default):
+    """First codec in the client's preference order that we also support"""
+    for codec in offered or []:
+        if codec in supported: return codec
+    return default
+
+def codec_metadata(codec):
+    meta = {"codec": codec}
+    if codec == "pcm": meta["rate"] = TTS_PCM_RATE
+    return meta
+
+def ffmpeg_command(input_args, output_args):
+    return [FFMPEG_CMD, "-loglevel", "error", *input_args, "-i", "pipe:0", *output_args, "pipe:1"]
+
+def transcode(data, input_args, output_args):
+    """One ffmpeg conversion, run on the encode stage"""
+    return ENCODE_STAGE.run(run_ffmpeg, bytes(data), input_args, output_args)
+
+def run_ffmpeg(data, input_args, output_args):
+    try:
+        result = subprocess.run(ffmpeg_command(input_args, output_args), input=data,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise TranscodeError(f"ffmpeg failed: {e}")
+    if result.returncode != 0 or not result.stdout:
+        raise TranscodeError(f"ffmpeg failed: {result.stderr.decode(errors='ignore').strip()[:200]}")
+    return result.stdout
+
+def encode_reply(mp3_data, codec):
+    """Converts gTTS MP3 into the wall's downlink codec"""
+    return transcode(mp3_data, CODEC_INPUT_ARGS["mp3"], CODEC_OUTPUT_ARGS[codec])
+
+def decode_upload(data, codec, rate=UPLOAD_SAMPLE_RATE):
+    """Returns 16-bit mono PCM for a compressed upload"""
+    return transcode(data, CODEC_INPUT_ARGS[codec], ["-f", "s16le", "-ac", "1", "-ar", str(rate)])
+
+class StreamDecoder:
+    """Decodes a compressed AUDIO_FRAME stream to PCM while it is arriving.
+
+    Frames are written to an ffmpeg process; a reader thread hands the PCM
+    it produces to sink (the ASR stream), so recognition keeps pace with
+    the upload instead of waiting for AUDIO_END.
+    """
+
+    def __init__(self, codec, sink, rate=UPLOAD_SAMPLE_RATE):
+        self.codec = codec
+        self.proc = subprocess.Popen(
+            ffmpeg_command(CODEC_INPUT_ARGS[codec], ["-f", "s16le", "-ac", "1", "-ar", str(rate)]),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.reader = threading.Thread(target=self._pump, args=(sink,), daemon=True)
+        self.reader.start()
+
+    def _pump(self, sink):
+        while True:
+            chunk = self.proc.stdout.read1(CHUNK_SIZE)
+            if not chunk: break
+            sink(chunk)
+
+    def feed(self, chunk):
+        try: self.proc.stdin.write(chunk)
+        except (BrokenPipeError, ValueError): pass
+
+    def finish(self):
+        """Flushes the decoder; all PCM has reached the sink when this returns"""
+        try: self.proc.stdin.close()
+        except BrokenPipeError: pass
+        self.reader.join()
+        self.proc.wait()
+
+    def close(self):
+        """Abandons the stream: stops ffmpeg without waiting for its output"""
+        try: self.proc.kill()
+        except OSError: pass
+        try: self.proc.stdin.close()
+        except OSError: pass
+        self.reader.join()
+        self.proc.wait()
+
+class UploadStream:
+    """One streamed utterance on its way into the recognizer.
+
+    Each AUDIO_FRAME declares its codec; raw PCM goes straight to the ASR
+    stream and compressed frames through a StreamDecoder first.
+    """
+
+    def __init__(self):
+        self.transcriber = ASR.stream()
+        self.decoder = None
+        self.frames = 0
+        self.trace = None
 
-def transcribe_audio(file_path):
+    def sink(self, header):
+        """Where the body of this AUDIO_FRAME goes (used as a receive_packet sink)"""
+        if self.trace is None:
+            self.trace = TurnTrace(header.get('trace'))
+            self.trace.mark("upload_start")
+        self.frames += 1
+        codec = header.get('payload', {}).get('codec', "pcm")
+        if codec == "pcm":
+            return self.transcriber.feed
+        if self.decoder is None or self.decoder.codec != codec:
+            if self.decoder: self.decoder.finish()
+            try:
+                self.decoder = StreamDecoder(codec, self.transcriber.feed)
+            except (OSError, KeyError) as e:
+                print(f"[CODEC] Cannot decode {codec} frames: {e}")
+                self.decoder = None
+                return lambda chunk: None
+        return self.decoder.feed
+
+    def finish(self):
+        if self.decoder: self.decoder.finish()
+        return self.transcriber.finish()
+
+    def close(self):
+        """An utterance nobody will transcribe (dropped or cut off): frees its decoder"""
+        if self.decoder: self.decoder.close()
+        self.decoder = None
+
+# --- SPEECH RECOGNITION ---
+
+ASRResult = namedtuple("ASRResult", "text confidence latency backend")
+
+class ASRStream:
+    """Incremental recognition of one utterance. This default one buffers the
+    PCM and recognizes it in one go when the utterance ends."""
+
+    def __init__(self, backend, sample_rate):
+        self.backend = backend
+        self.sample_rate = sample_rate
+        self.pcm = bytearray()
+        self.bytes_fed = 0
+
+    def feed(self, chunk):
+        self.pcm += chunk
+        self.bytes_fed += len(chunk)
+
+    def _finish(self):
+        return ASR_STAGE.run(recognize_pcm, bytes(self.pcm), self.sample_rate)
+
+    def finish(self):
+        start = time.time()
+        try:
+            text, confidence = self._finish() if self.bytes_fed else ("", 0.0)
+        except Exception as e:
+            return self.backend.failed(e, time.time() - start)
+        return self.backend.report(text, confidence, time.time() - start)
+
+class ASRBackend:
+    """Speech recognizer interface.
+
+    load() does the expensive setup once at startup so every turn finds the
+    engine warm; recognize(pcm, sample_rate) takes 16-bit mono PCM from memory
+    and returns (text, confidence).
+    """
+    name = "base"
+    stream_class = ASRStream
+
+    def load(self):
+        pass
+
+    def recognize(self, pcm, sample_rate):
+        raise NotImplementedError
+
+    def stream(self, sample_rate=UPLOAD_SAMPLE_RATE):
+        return self.stream_class(self, sample_rate)
+
+    def report(self, text, confidence, latency):
+        print(f"[ASR] {self.name}: {latency * 1000:.0f} ms, confidence {confidence:.2f}")
+        return ASRResult(text, confidence, latency, self.name)
+
+    def failed(self, error, latency):
+        """A recognizer error is treated as silence; the chat goes on"""
+        print(f"[ASR] {self.name} failed after {latency * 1000:.0f} ms: {error}")
+        return ASRResult("", 0.0, latency, self.name)
+
+    def transcribe(self, pcm, sample_rate=UPLOAD_SAMPLE_RATE):
+        start = time.time()
+        try:
+            text, confidence = ASR_STAGE.run(recognize_pcm, bytes(pcm), sample_rate)
+        except Exception as e:
+            return self.failed(e, time.time() - start)
+        return self.report(text, confidence, time.time() - start)
+
+class GoogleASR(ASRBackend):
+    """Google Web Speech through speech_recognition (needs internet)"""
+    name = "google"
+
+    def load(self):
+        import speech_recognition
+        self.sr = speech_recognition
+        self.recognizer = speech_recognition.Recognizer()
+
+    def recognize(self, pcm, sample_rate):
+        audio = self.sr.AudioData(bytes(pcm), sample_rate, 2)
+        try:
+            result = self.recognizer.recognize_google(audio, show_all=True)
+        except self.sr.UnknownValueError:
+            return "", 0.0
+        except self.sr.RequestError as e:
+            print(f"[ASR] Google request failed: {e}")
+            return "", 0.0
+        alternatives = result.get('alternative', []) if isinstance(result, dict) else []
+        if not alternatives: return "", 0.0
+        best = alternatives[0]
+        return best.get('transcript', ""), float(best.get('confidence', 0.0))
+
+class VoskStream(ASRStream):
+    """Feeds each frame straight into the Kaldi decoder while the visitor talks"""
+
+    def __init__(self, backend, sample_rate):
+        super().__init__(backend, sample_rate)
+        self.recognizer = backend.new_recognizer(sample_rate)
+
+    def feed(self, chunk):
+        self.recognizer.AcceptWaveform(bytes(chunk))
+        self.bytes_fed += len(chunk)
+
+    def _finish(self):
+        return self.backend.parse(self.recognizer.FinalResult())
+
+class VoskASR(ASRBackend):
+    """Offline recognizer; the model is loaded once and shared by all sessions"""
+    name = "vosk"
+    stream_class = VoskStream
+
+    def __init__(self, model_path=VOSK_MODEL_PATH):
+        self.model_path = model_path
+        self.model = None
+
+    def load(self):
+        from vosk import Model, SetLogLevel
+        SetLogLevel(-1)
+        start = time.time()
+        self.model = Model(self.model_path)
+        print(f"[ASR] Vosk model loaded in {time.time() - start:.1f}s")
+
+    def new_recognizer(self, sample_rate):
+        from vosk import KaldiRecognizer
+        recognizer = KaldiRecognizer(self.model, sample_rate)
+        recognizer.SetWords(True)
+        return recognizer
+
+    @staticmethod
+    def parse(result_json):
+        result = json.loads(result_json)
+        words = result.get('result', [])
+        confidence = sum(w.get('conf', 0.0) for w in words) / len(words) if words else 0.0
+        return result.get('text', ""), confidence
+
+    def recognize(self, pcm, sample_rate):
+        recognizer = self.new_recognizer(sample_rate)
+        recognizer.AcceptWaveform(bytes(pcm))
+        return self.parse(recognizer.FinalResult())
+
+ASR_BACKENDS = {"google": GoogleASR, "vosk": VoskASR}
+ASR = ASR_BACKENDS[ASR_BACKEND]()
+
+def load_asr():
+    try:
+        ASR.load()
+    except Exception as e:
+        print(f"[ASR] Could not load {ASR.name} backend: {e}")
+        raise
+
+def read_wav_pcm(wav_data):
+    """Returns (pcm, sample_rate) for a mono 16-bit WAV held in memory"""
+    with wave.open(io.BytesIO(wav_data), "rb") as w:
+        return w.readframes(w.getnframes()), w.getframerate()
+
+def transcribe_audio(data, codec="wav", rate=UPLOAD_SAMPLE_RATE):
+    """Transcribes one whole AUDIO upload held in memory"""
     print(">> Transcribing...")
-    r = sr.Recognizer()
     try:
-        with sr.AudioFile(file_path) as source:
-            audio = r.record(source)
-            return r.recognize_google(audio)
-    except: return ""
-
-def send_packet(conn, msg_type, file_path=None, payload=None):
-    header = {"type": msg_type, "file_size": 0, "payload": payload or {}}
-    if file_path and os.path.exists(file_path):
-        header['file_size'] = os.path.getsize(file_path)
-    
+        if codec == "wav":
+            pcm, rate = read_wav_pcm(data)
+        elif codec == "pcm":
+            pcm = data
+        else:
+            pcm = decode_upload(data, codec, rate)
+    except (OSError, wave.Error, EOFError, KeyError, TranscodeError) as e:
+        print(f"[ASR] Unreadable {codec} upload: {e}")
+        return ""
+    return ASR.transcribe(pcm, rate).text
+
+# --- HEADERS ---
+# Every packet starts with a 4-byte big-endian header length. With the top bit
+# clear the header is JSON. With it set the header is binary: message type
+# code, body size and trace id packed in a fixed struct, followed by the
+# payload as JSON only if there is one. Both sides always accept both; the
+# binary form is only sent to a peer that offered it in HELLO.
+
+BINARY_FLAG = 0x80000000
+BINARY_HEADER = struct.Struct('>BI8s')  # type code, file_size, trace id
+
+# Codes are positions in this list, shared with pi_greenwall_client.py: only ever append
+MESSAGE_TYPES = (
+    "HELLO", "HELLO_ACK", "PIR_TRIGGER", "USER_ENTER", "SOIL_DATA", "GET_SOIL",
+    "SUBSCRIBE_SOIL", "SPEAK_INTRO", "SPEAK", "SPEAK_CHUNK", "AUDIO", "AUDIO_FRAME",
+    "AUDIO_END", "END_SESSION", "INTERRUPT", "TRACE", "GET_STATS", "STATS", "READY",
+    "ACK",
+)
+MESSAGE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES)}
+
+def encode_header(msg_type, file_size, payload=None, trace=None, binary=False):
+    """Length prefix plus header; falls back to JSON for anything the struct cannot hold"""
+    if binary and msg_type in MESSAGE_CODES:
+        try:
+            trace_bytes = bytes.fromhex(trace) if trace else bytes(8)
+        except ValueError:
+            trace_bytes = b""
+        if len(trace_bytes) == 8:
+            body = BINARY_HEADER.pack(MESSAGE_CODES[msg_type], file_size, trace_bytes)
+            if payload: body += json.dumps(payload).encode('utf-8')
+            return struct.pack('>I', BINARY_FLAG | len(body)) + body
+    header = {"type": msg_type, "file_size": file_size, "payload": payload or {}}
+    if trace: header['trace'] = trace
+    header_bytes = json.dumps(header).encode('utf-8')
+    return struct.pack('>I', len(header_bytes)) + header_bytes
+
+def decode_header(prefix, header_bytes):
+    """Header dict from the length prefix word and the header bytes"""
+    if not prefix & BINARY_FLAG:
+        return json.loads(header_bytes.decode('utf-8'))
+    code, file_size, trace = BINARY_HEADER.unpack_from(header_bytes)
+    extra = header_bytes[BINARY_HEADER.size:]
+    header = {"type": MESSAGE_TYPES[code], "file_size": file_size,
+              "payload": json.loads(extra.decode('utf-8')) if extra else {}}
+    if any(trace): header['trace'] = trace.hex()
+    return header
+
+def send_packet(conn, msg_type, payload=None, data=None, trace=None, binary=False):
+    file_size = len(data) if data is not None else 0
     try:
-        header_bytes = json.dumps(header).encode('utf-8')
-        conn.send(struct.pack('>I', len(header_bytes)))
-        conn.send(header_bytes)
-        if header['file_size'] > 0:
-            with open(file_path, "rb") as f:
-                conn.sendall(f.read())
+        conn.sendall(encode_header(msg_type, file_size, payload, trace, binary))
+        if data is not None:
+            conn.sendall(data)
     except Exception as e:
         print(f"Send Error: {e}")
 
-# Robust Receiver (prevents JSON errors)
+# --- FRAMING ---
+# Bodies are read with recv_into so no intermediate bytes objects get
+# concatenated; large audio can also be streamed chunk by chunk to a sink.
+
 def recvall(sock, n):
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet: return None
-        data += packet
-    return data
+    """Reads exactly n bytes into one preallocated buffer"""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        count = sock.recv_into(view[got:], n - got)
+        if not count: return None
+        got += count
+    return buf
 
-def receive_packet(conn):
+def recv_stream(sock, n, sink, chunk_size=CHUNK_SIZE):
+    """Streams an n-byte body into sink without holding it all in memory.
+
+    sink is a file-like object (anything with write) or a callable taking
+    each chunk. Chunks are memoryviews over a reused buffer, so a callable
+    must copy what it wants to keep. Returns False if the peer hangs up.
+    """
+    write = sink.write if hasattr(sink, "write") else sink
+    buf = bytearray(min(chunk_size, n) or 1)
+    view = memoryview(buf)
+    remaining = n
+    while remaining > 0:
+        count = sock.recv_into(view, min(len(buf), remaining))
+        if not count: return False
+        write(view[:count])
+        remaining -= count
+    return True
+
+def receive_packet(conn, sinks=None):
+    """Reads one packet. A body goes into header['data'], unless sinks has an
+    entry for the packet type: that is called with the header and returns the
+    sink (see recv_stream) to stream this body into."""
     try:
         len_bytes = recvall(conn, 4)
         if not len_bytes: return None
-        header_len = struct.unpack('>I', len_bytes)[0]
+        prefix = struct.unpack('>I', len_bytes)[0]
         
-        header_bytes = recvall(conn, header_len)
+        header_bytes = recvall(conn, prefix & ~BINARY_FLAG)
         if not header_bytes: return None
         
-        header = json.loads(header_bytes.decode('utf-8'))
+        header = decode_header(prefix, header_bytes)
         
         if header.get('file_size', 0) > 0:
-            print(f">> Receiving file {header['file_size']} bytes...")
-            file_data = recvall(conn, header['file_size'])
-            if file_data:
-                with open("input.wav", "wb") as f:
-                    f.write(file_data)
+            if header.get('type') != 'AUDIO_FRAME':
+                print(f">> Receiving file {header['file_size']} bytes...")
+            sink_for = (sinks or {}).get(header.get('type'))
+            if sink_for is not None:
+                if not recv_stream(conn, header['file_size'], sink_for(header)): return None
+            else:
+                header['data'] = recvall(conn, header['file_size'])
+                if header['data'] is None: return None
         return header
     except socket.timeout:
         return "TIMEOUT"
@@ -93,166 +899,1538 @@ def receive_packet(conn):
         print(f"Receive Error: {e}")
         return None
 
+class Dispatcher:
+    """Background reader that routes one wall's packets by type.
+
+    A single thread owns the receive side of the socket and deals with each
+    packet the moment it arrives. Bodies with a registered sink stream
+    straight into it. A handler registered for the type runs right on the
+    reader thread; the packet is consumed unless the handler returns it.
+    Everything else waits in a per-type queue until the session thread asks
+    for that type, so nothing is lost or misread because the session was
+    waiting for something else.
+    """
+
+    def __init__(self, conn, name="wall"):
+        self.conn = conn
+        self.sinks = {}     # type -> callable(header) returning the body sink
+        self.handlers = {}  # type -> callable(msg) run on the reader thread
+        self.queues = {}    # type -> deque of (arrival number, msg)
+        self.arrivals = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name=f"{name}-reader", daemon=True)
+
+    def on(self, msg_type, handler):
+        self.handlers[msg_type] = handler
+
+    def sink(self, msg_type, sink_for):
+        self.sinks[msg_type] = sink_for
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                ready, _, _ = select.select([self.conn], [], [], 1.0)
+            except (OSError, ValueError):
+                break
+            if not ready: continue
+            # Data is waiting, so a timeout here means the wall stalled mid-packet
+            msg = receive_packet(self.conn, sinks=self.sinks)
+            if not isinstance(msg, dict): break
+            self.route(msg)
+        # After a stall or garbage the stream is out of step; hanging up makes the wall reconnect
+        try: self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def route(self, msg):
+        handler = self.handlers.get(msg.get('type'))
+        if handler is not None:
+            try:
+                msg = handler(msg)
+            except Exception as e:
+                print(f"Handler Error ({msg.get('type')}): {e}")
+                msg = None
+        if msg: self.deliver(msg)
+
+    def deliver(self, msg):
+        with self.cond:
+            self.arrivals += 1
+            self.queues.setdefault(msg.get('type'), deque(maxlen=PACKET_QUEUE_LIMIT)).append((self.arrivals, msg))
+            self.cond.notify_all()
+
+    def get(self, types, timeout=None):
+        """Oldest queued packet of one of types: a dict, "TIMEOUT", or None once the wall hung up"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.cond:
+            while True:
+                heads = [self.queues[t][0] for t in types if self.queues.get(t)]
+                if heads:
+                    _, msg = min(heads, key=lambda item: item[0])
+                    self.queues[msg['type']].popleft()
+                    return msg
+                if self.closed: return None
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0: return "TIMEOUT"
+                self.cond.wait(remaining)
+
+    def discard(self, *types):
+        """Drops queued packets that no longer mean anything (e.g. a stale USER_ENTER);
+        an upload one of them carries is closed"""
+        with self.cond:
+            dropped = [msg for t in types for _, msg in self.queues.pop(t, ())]
+        for msg in dropped:
+            if msg.get('upload'): msg['upload'].close()
+
+# --- TRACING ---
+# Each turn carries a trace id in the packet header. Stages are timed on this
+# machine's monotonic clock; the client times its own stages the same way and
+# reports them in a TRACE packet. Everything lands in per-stage histograms.
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# (stage, start mark, end mark) measured on the server for every turn
+TURN_SPANS = (
+    ("intro", "trigger", "first_audio_sent"),
+    ("receive", "upload_start", "upload_end"),
+    ("asr", "asr_start", "asr_end"),
+    ("llm_wait", "llm_start", "llm_slot"),  # This turn's share of llm_queue
+    ("llm_first_token", "llm_start", "llm_first_token"),
+    ("llm_total", "llm_start", "llm_end"),
+    ("first_audio", "upload_end", "first_audio_sent"),
+    ("turn", "upload_end", "last_audio_sent"),
+)
+
+def new_trace_id():
+    return os.urandom(8).hex()
+
+class StageHistogram:
+    """Latency of one stage: cumulative Prometheus buckets plus a window of
+    recent samples for percentiles"""
+
+    def __init__(self):
+        self.buckets = [0] * len(STAGE_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=TRACE_SAMPLES)
+
+    def observe(self, seconds):
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound: self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)):
+        ordered = sorted(self.recent)
+        if not ordered: return {}
+        # Nearest-rank percentile
+        return {q: ordered[max(0, math.ceil(q * len(ordered)) - 1)] for q in quantiles}
+
+class Metrics:
+    """Per-stage latency histograms shared by all sessions"""
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.stages.setdefault(stage, StageHistogram()).observe(seconds)
+
+    def snapshot(self):
+        """{stage: {count, mean, p50, p95, p99}} in seconds"""
+        with self.lock:
+            out = {}
+            for stage, h in sorted(self.stages.items()):
+                pct = h.percentiles()
+                out[stage] = {"count": h.count, "mean": round(h.sum / h.count, 4),
+                              **{f"p{int(q * 100)}": round(v, 4) for q, v in pct.items()}}
+            return out
+
+    def prometheus(self):
+        """Prometheus text exposition of the histograms and a few gauges"""
+        lines = ["# HELP greenwall_stage_seconds Time spent in each stage of a turn",
+                 "# TYPE greenwall_stage_seconds histogram"]
+        quantiles = ["# HELP greenwall_stage_recent_seconds Percentiles over recent turns",
+                     "# TYPE greenwall_stage_recent_seconds gauge"]
+        with self.lock:
+            for stage, h in sorted(self.stages.items()):
+                for bound, n in zip(STAGE_BUCKETS, h.buckets):
+                    lines.append(f'greenwall_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {n}')
+                lines.append(f'greenwall_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'greenwall_stage_seconds_sum{{stage="{stage}"}} {h.sum:.6f}')
+                lines.append(f'greenwall_stage_seconds_count{{stage="{stage}"}} {h.count}')
+                for q, v in h.percentiles().items():
+                    quantiles.append(f'greenwall_stage_recent_seconds{{stage="{stage}",quantile="{q}"}} {v:.6f}')
+        cache = TTS_CACHE.stats()
+        answers = ANSWER_CACHE.stats()
+        with ACTIVE_LOCK: walls = len(ACTIVE_SESSIONS)
+        pools = stage_stats()
+        for metric in ("queued", "in_flight", "utilization"):
+            quantiles.append(f"# TYPE greenwall_pool_{metric} gauge")
+            quantiles += [f'greenwall_pool_{metric}{{stage="{name}"}} {pool[metric]}' for name, pool in pools.items()]
+        lines += quantiles + [
+            "# TYPE greenwall_active_walls gauge", f"greenwall_active_walls {walls}",
+            "# TYPE greenwall_tts_cache_hits_total counter", f"greenwall_tts_cache_hits_total {cache['hits']}",
+            "# TYPE greenwall_tts_cache_misses_total counter", f"greenwall_tts_cache_misses_total {cache['misses']}",
+            "# TYPE greenwall_answer_cache_hits_total counter", f"greenwall_answer_cache_hits_total {answers['hits']}",
+            "# TYPE greenwall_answer_cache_misses_total counter", f"greenwall_answer_cache_misses_total {answers['misses']}",
+            "# TYPE greenwall_llm_shed_total counter", f"greenwall_llm_shed_total {pools['llm']['shed']}"]
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+class TurnTrace:
+    """Monotonic timestamps of the stages of one turn"""
+
+    def __init__(self, trace_id=None):
+        self.id = trace_id or new_trace_id()
+        self.marks = {}
+
+    def mark(self, name, first=True):
+        """Records when name happened; with first=True later calls are ignored"""
+        if first: self.marks.setdefault(name, time.monotonic())
+        else: self.marks[name] = time.monotonic()
+
+    def finish(self, session):
+        """Files every complete span into METRICS and logs the breakdown"""
+        spent = []
+        for stage, start, end in TURN_SPANS:
+            if start in self.marks and end in self.marks:
+                seconds = self.marks[end] - self.marks[start]
+                METRICS.observe(stage, seconds)
+                spent.append(f"{stage} {seconds * 1000:.0f}ms")
+        if TRACE_LOG and spent:
+            session.log(f"[TRACE {self.id}] " + ", ".join(spent))
+
+def record_client_trace(payload):
+    """Stage timings measured on the wall (TRACE packet), filed as client_<stage>"""
+    for stage, seconds in (payload.get('stages') or {}).items():
+        if isinstance(seconds, (int, float)) and 0 <= seconds < 3600 and str(stage).isidentifier():
+            METRICS.observe(f"client_{stage}", float(seconds))
+
+class StatsHandler(BaseHTTPRequestHandler):
+    """GET /metrics (Prometheus text), /stats (JSON percentiles), /pools (worker stages),
+    /fleet (drying forecast per wall) and /ready (503 until warm-up is done)"""
+
+    def do_GET(self):
+        status = 200
+        if self.path == "/metrics":
+            body, kind = METRICS.prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/stats":
+            body, kind = json.dumps(METRICS.snapshot(), indent=1).encode(), "application/json"
+        elif self.path == "/pools":
+            body, kind = json.dumps(stage_stats(), indent=1).encode(), "application/json"
+        elif self.path == "/fleet":
+            body = json.dumps({"computed": FLEET.computed, "walls": FLEET.forecast}, indent=1).encode()
+            kind = "application/json"
+        elif self.path == "/ready":
+            status = 200 if SERVER_READY.is_set() else 503
+            body = json.dumps({"ready": SERVER_READY.is_set(), "warmup": WARMUP_RESULTS}).encode()
+            kind = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", kind)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # Scrapes would flood the console
+
+def start_stats_server():
+    try:
+        httpd = ThreadingHTTPServer((HOST_IP, STATS_PORT), StatsHandler)
+    except OSError as e:
+        print(f"[STATS] Endpoint unavailable: {e}")
+        return None
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"[STATS] Metrics on http://{HOST_IP}:{STATS_PORT}/metrics")
+    return httpd
+
+# --- WORKER STAGES ---
+# Recognition, synthesis and transcoding each run on their own pool, shared by
+# every wall, so one wall's ASR overlaps another's TTS and a burst on one
+# stage cannot starve the others. The session threads only wait for results.
+
+def timed_call(fn, *args):
+    """Runs fn in a worker (thread or process) and reports when it ran, for the stage stats"""
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time() - started
+
+class Stage:
+    """One pipeline stage: a worker pool with a bounded queue and usage stats.
+
+    submit() blocks once workers + queue_limit jobs are in flight, so a
+    backlog holds the producers back instead of piling up. Time spent waiting
+    for a worker is filed in METRICS as <name>_queue.
+    """
+
+    def __init__(self, name, workers, kind="thread", queue_limit=STAGE_QUEUE_LIMIT, initializer=None):
+        self.name = name
+        self.workers = workers
+        self.kind = kind
+        if kind == "process":
+            # spawn, not fork: the server is full of threads by the time the pool starts
+            self.pool = ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+        self.in_flight = 0
+        self.completed = 0
+        self.busy = deque()  # (finished at, seconds of work) within STAGE_WINDOW
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Future of fn(*args); with a process pool fn and args must be picklable"""
+        self.slots.acquire()
+        submitted = time.time()
+        with self.lock: self.in_flight += 1
+        future = Future()
+        try:
+            inner = self.pool.submit(timed_call, fn, *args)
+        except Exception:
+            self._done(None, 0.0)
+            raise
+        future.add_done_callback(lambda f: f.cancelled() and inner.cancel())
+        inner.add_done_callback(lambda inner: self._finished(inner, future, submitted))
+        return future
+
+    def run(self, fn, *args):
+        """fn(*args) on this stage, waiting for the result"""
+        return self.submit(fn, *args).result()
+
+    def _finished(self, inner, future, submitted):
+        if inner.cancelled():
+            self._done(None, 0.0)
+            future.cancel()
+            return
+        try:
+            result, started, seconds = inner.result()
+        except BaseException as e:
+            self._done(None, 0.0)
+            try: future.set_exception(e)
+            except InvalidStateError: pass  # Cancelled meanwhile
+            return
+        self._done(time.time(), seconds)
+        METRICS.observe(f"{self.name}_queue", max(0.0, started - submitted))
+        try: future.set_result(result)
+        except InvalidStateError: pass
+
+    def _done(self, finished, seconds):
+        with self.lock:
+            self.in_flight -= 1
+            if finished is not None:
+                self.completed += 1
+                self.busy.append((finished, seconds))
+        self.slots.release()
+
+    def stats(self):
+        """Queue depth and the share of worker time spent busy over the last STAGE_WINDOW"""
+        now = time.time()
+        with self.lock:
+            while self.busy and self.busy[0][0] < now - STAGE_WINDOW:
+                self.busy.popleft()
+            window = min(STAGE_WINDOW, now - self.started) or 1e-9
+            busy = sum(seconds for _, seconds in self.busy)
+            return {"kind": self.kind, "workers": self.workers, "in_flight": self.in_flight,
+                    "queued": max(0, self.in_flight - self.workers), "completed": self.completed,
+                    "utilization": round(min(1.0, busy / (self.workers * window)), 3)}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+def recognize_pcm(pcm, sample_rate):
+    """ASR stage job; in a worker process ASR is that process's own backend"""
+    return ASR.recognize(pcm, sample_rate)
+
+ASR_STAGE = Stage("asr", ASR_WORKERS, kind=ASR_POOL, initializer=load_asr)
+TTS_STAGE = Stage("tts", TTS_WORKERS)
+ENCODE_STAGE = Stage("encode", ENCODE_WORKERS)
+STAGES = (ASR_STAGE, TTS_STAGE, ENCODE_STAGE)
+
+def stage_stats():
+    stats = {stage.name: stage.stats() for stage in STAGES}
+    stats["llm"] = LLM_SCHEDULER.stats()
+    return stats
+
+# --- FLEET TELEMETRY ---
+
+class SoilLog:
+    """Append-only log of every wall's soil readings, one memory-mapped file per column.
+
+    Rows are (time float64, wall uint16, soil float32), in arrival order;
+    wall ids are numbered in walls.json. The files are preallocated, so an
+    append is three stores into the maps and readers get NumPy arrays
+    straight from them. Unwritten rows have time 0, which is how the row
+    count is found again after a restart.
+    """
+    COLUMNS = (("time", "d"), ("wall", "H"), ("soil", "f"))
+
+    def __init__(self, directory=TELEMETRY_DIR, capacity=TELEMETRY_CAPACITY):
+        self.directory = directory
+        self.capacity = capacity
+        self.maps = {}
+        self.views = {}
+        self.walls = []   # index -> wall id
+        self.index = {}   # wall id -> index
+        self.last = {}    # wall index -> (time, soil) of its newest row
+        self.count = 0
+        self.state = None # None until opened, then "open" or "failed"
+        self.lock = threading.Lock()
+
+    def _open(self):
+        # Caller holds the lock
+        os.makedirs(self.directory, exist_ok=True)
+        for name, code in self.COLUMNS:
+            path = os.path.join(self.directory, f"soil_{name}.bin")
+            size = self.capacity * struct.calcsize(code)
+            with open(path, "ab"): pass
+            with open(path, "r+b") as f:
+                if os.path.getsize(path) != size: f.truncate(size)
+                self.maps[name] = mmap.mmap(f.fileno(), size)
+            self.views[name] = memoryview(self.maps[name]).cast(code)
+        try:
+            with open(os.path.join(self.directory, "walls.json")) as f:
+                self.walls = json.load(f)
+        except (OSError, ValueError):
+            self.walls = []
+        self.index = {wall: i for i, wall in enumerate(self.walls)}
+        times = self.views["time"]
+        lo, hi = 0, self.capacity
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[mid] > 0: lo = mid + 1
+            else: hi = mid
+        self.count = lo
+        print(f"[FLEET] Soil log: {self.count} readings from {len(self.walls)} walls")
+
+    def _wall(self, wall_id):
+        # Caller holds the lock
+        wall = self.index.get(wall_id)
+        if wall is None:
+            wall = self.index[wall_id] = len(self.walls)
+            self.walls.append(wall_id)
+            path = os.path.join(self.directory, "walls.json")
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(self.walls, f)
+            os.replace(f"{path}.tmp", path)
+        return wall
+
+    def _compact(self):
+        # Caller holds the lock; keeps the newest half
+        keep = self.count // 2
+        drop = self.count - keep
+        for name, code in self.COLUMNS:
+            size = struct.calcsize(code)
+            self.maps[name].move(0, drop * size, keep * size)
+            self.maps[name][keep * size:self.count * size] = bytes(drop * size)
+        self.count = keep
+
+    def append(self, wall_id, soil, timestamp):
+        with self.lock:
+            if self.state is None:
+                try:
+                    self._open()
+                    self.state = "open"
+                except OSError as e:
+                    print(f"[FLEET] Soil log unavailable: {e}")
+                    self.state = "failed"
+            if self.state != "open": return
+            try: wall = self._wall(wall_id)
+            except OSError as e:
+                print(f"[FLEET] Could not register wall {wall_id}: {e}")
+                return
+            last = self.last.get(wall)
+            if last and last[1] == soil and timestamp - last[0] < TELEMETRY_MIN_INTERVAL: return
+            if self.count == self.capacity: self._compact()
+            row = self.count
+            self.views["wall"][row] = wall
+            self.views["soil"][row] = soil
+            self.views["time"][row] = timestamp  # Written last: a row with a time is complete
+            self.count += 1
+            self.last[wall] = (timestamp, soil)
+
+    def snapshot(self, since, np):
+        """Copies of (times, walls, soils) logged at or after since, plus the wall ids"""
+        with self.lock:
+            if self.state != "open":
+                return np.zeros(0), np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=np.float32), []
+            n = self.count
+            times = np.frombuffer(self.maps["time"], dtype=np.float64, count=n)
+            recent = times >= since
+            return (times[recent], np.frombuffer(self.maps["wall"], dtype=np.uint16, count=n)[recent],
+                    np.frombuffer(self.maps["soil"], dtype=np.float32, count=n)[recent], list(self.walls))
+
+def fleet_forecast(log, np, now):
+    """Drying rate and time until dry (below SOIL_DRY_THRESHOLD) for every wall at once.
+
+    Readings are rolled up into FORECAST_BUCKET means per wall. A rise of
+    FORECAST_WATERING_JUMP between buckets is a watering, and a least-squares
+    line is fitted to each wall's buckets since its latest one. All walls
+    are fitted together with bincount sums, with no loop over walls.
+    """
+    times, walls, soils, names = log.snapshot(now - FORECAST_WINDOW, np)
+    if not len(times): return {}
+    count = len(names)
+
+    # Rollups: one row per (wall, bucket), ordered by wall then time
+    buckets = np.floor(times / FORECAST_BUCKET)
+    order = np.lexsort((times, buckets, walls))
+    times, buckets, walls, soils = times[order], buckets[order], walls[order].astype(np.int64), soils[order].astype(np.float64)
+    new_wall = np.r_[True, walls[1:] != walls[:-1]]
+    starts = np.flatnonzero(new_wall | np.r_[True, buckets[1:] != buckets[:-1]])
+    sizes = np.diff(np.r_[starts, len(times)])
+    means = np.add.reduceat(soils, starts) / sizes
+    hours = (np.add.reduceat(times, starts) / sizes - now) / 3600
+    owner = walls[starts]
+
+    # Only buckets since each wall's latest watering (or its first bucket) count
+    first = np.r_[True, owner[1:] != owner[:-1]]
+    watered = np.r_[False, np.diff(means) > FORECAST_WATERING_JUMP] & ~first
+    run_start = np.zeros(count, dtype=np.int64)
+    np.maximum.at(run_start, owner, np.where(first | watered, np.arange(len(owner)), 0))
+    fit = np.arange(len(owner)) >= run_start[owner]
+    x, y, g = hours[fit], means[fit], owner[fit]
+
+    n = np.bincount(g, minlength=count)
+    sx, sy = np.bincount(g, x, count), np.bincount(g, y, count)
+    sxx, sxy = np.bincount(g, x * x, count), np.bincount(g, x * y, count)
+    denom = n * sxx - sx * sx
+    fitted = (n >= FORECAST_MIN_BUCKETS) & (denom > 0)
+    slope = np.where(fitted, (n * sxy - sx * sy) / np.where(fitted, denom, 1), np.nan)
+    slope = np.where(np.abs(slope) < FORECAST_FLAT_SLOPE, 0.0, slope)  # A steady wall never dries
+
+    # Latest reading of each wall
+    last = np.r_[np.flatnonzero(new_wall)[1:] - 1, len(times) - 1]
+    current = np.full(count, np.nan)
+    current[walls[last]] = soils[last]
+    seen = np.full(count, np.nan)
+    seen[walls[last]] = times[last]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        to_dry = np.where(slope < 0, (current - SOIL_DRY_THRESHOLD) / -slope, np.inf)
+    to_dry = np.where(current < SOIL_DRY_THRESHOLD, 0.0, np.where(np.isnan(slope), np.nan, to_dry))
+
+    def value(v, digits):
+        return None if not np.isfinite(v) else round(float(v), digits)
+    return {names[i]: {"soil": value(current[i], 1), "seen": value(seen[i], 0),
+                       "slope_per_hour": value(slope[i], 2), "hours_to_dry": value(to_dry[i], 1),
+                       "dry_within_horizon": bool(to_dry[i] <= FORECAST_HORIZON / 3600),
+                       "buckets": int(n[i])}
+            for i in np.flatnonzero(~np.isnan(current))}
+
+def fleet_note(forecast, wall_id):
+    """The forecast as one system note for a wall's chat, or None if there is nothing to say"""
+    horizon = FORECAST_HORIZON // 3600
+    due = sorted((row['hours_to_dry'], name) for name, row in forecast.items()
+                 if row['dry_within_horizon'] and name != wall_id)
+    parts = []
+    if len(forecast) > (wall_id in forecast):
+        named = ", ".join(f"{name} {'is already dry' if h == 0 else f'in about {h:.0f} hours'}" for h, name in due[:3])
+        others = len(forecast) - (wall_id in forecast)
+        parts.append(f"{len(due)} of the other {others} green walls will need water within "
+                     f"{horizon} hours" + (f" ({named})." if named else "."))
+    own = forecast.get(wall_id)
+    if own and own['hours_to_dry'] == 0:
+        parts.append(f"Your own soil is already below {SOIL_DRY_THRESHOLD} percent.")
+    elif own and own['slope_per_hour'] is not None and own['slope_per_hour'] < 0:
+        own_part = f"Your own soil is drying about {-own['slope_per_hour']:.1f} percent per hour"
+        if own['hours_to_dry'] is not None:
+            own_part += f" and should drop below {SOIL_DRY_THRESHOLD} percent in about {own['hours_to_dry']:.0f} hours"
+        parts.append(own_part + ".")
+    return "SYSTEM NOTE: Fleet forecast. " + " ".join(parts) if parts else None
+
+class FleetTelemetry:
+    """Soil readings from every connected wall, and the forecast computed from them in batch.
+
+    The forecast and each wall's chat note are recomputed every
+    FORECAST_INTERVAL seconds, so starting a chat only looks up a string.
+    Forecasts need NumPy; without it readings are still logged.
+    """
+
+    def __init__(self):
+        self.log = SoilLog()
+        self.forecast = {}  # wall id -> forecast row
+        self.notes = {}     # wall id -> chat note (None: a wall with no readings yet)
+        self.computed = None
+        self.disabled = False
+
+    def record(self, wall_id, soil, timestamp):
+        self.log.append(wall_id, soil, timestamp)
+
+    def refresh(self, now=None):
+        try:
+            import numpy as np
+        except ImportError:
+            if not self.disabled: print("[FLEET] NumPy is not installed; drying forecasts are off")
+            self.disabled = True
+            return
+        now = now or time.time()
+        start = time.monotonic()
+        forecast = fleet_forecast(self.log, np, now)
+        notes = {wall: fleet_note(forecast, wall) for wall in forecast}
+        notes[None] = fleet_note(forecast, None)
+        self.forecast, self.notes, self.computed = forecast, notes, now
+        due = sum(row['dry_within_horizon'] for row in forecast.values())
+        print(f"[FLEET] Forecast for {len(forecast)} walls in {(time.monotonic() - start) * 1000:.0f} ms; "
+              f"{due} dry within {FORECAST_HORIZON // 3600} hours")
+
+    def note(self, wall_id):
+        return self.notes.get(wall_id, self.notes.get(None))
+
+    def run(self):
+        while True:
+            try: self.refresh()
+            except Exception as e: print(f"[FLEET] Forecast failed: {e}")
+            if self.disabled: return
+            time.sleep(FORECAST_INTERVAL)
+
+FLEET = FleetTelemetry()
+
+# --- SESSION ---
+
+class WallSession:
+    """Per-wall state, so several walls can talk to the brain at once.
+
+    Normally a session lives as long as its connection. A wall that offers
+    "resume" in its HELLO gets a session id and token instead; if its socket
+    drops, receive() holds the session (conversation, soil readings, audio
+    not yet acknowledged) for RESUME_GRACE seconds, and a HELLO carrying the
+    token moves it onto the new connection (attach) and replays what the
+    wall missed.
+    """
+    _ids = 0
+    _ids_lock = threading.Lock()
+
+    def __init__(self, conn, addr):
+        with WallSession._ids_lock:
+            WallSession._ids += 1
+            self.id = WallSession._ids
+        self.conn = conn
+        self.addr = addr
+        self.enter_timeout = ENTER_TIMEOUT
+        self.reminder_timeout = REMINDER_TIMEOUT
+        self.chat_timeout = CHAT_TIMEOUT
+        self.soil_timeout = SOIL_TIMEOUT
+        self.timeout = None      # How long receive() waits (settimeout)
+        self.context = None
+        self.soil = None         # Latest pushed soil reading and when it arrived
+        self.soil_time = 0.0
+        self.soil_event = threading.Event()
+        self.wall_id = addr[0] if addr else "wall"  # Name in the fleet telemetry (HELLO may give one)
+        self.uplink = "pcm"      # Codecs agreed in the handshake; these defaults are what
+        self.downlink = "mp3"    # clients without HELLO have always sent and played
+        self.binary = False      # Send struct-packed headers (the wall offered them)
+        self.wants_ready = False # The wall waits for a READY packet before it starts sessions
+        self.send_lock = threading.Lock()
+        self.turn = 0            # Id of the reply being spoken; INTERRUPT names the one it stops
+        self.cancelled = threading.Event()
+        self.fallback = False    # This turn's reply is a fallback, not the model's answer
+        self.replies = 0         # LLM replies in the current chat; the first one is served first
+        self.trace = None        # TurnTrace of the turn in progress
+        self.upload = None       # UploadStream the wall's AUDIO_FRAMEs are feeding
+
+        # Resume state
+        self.session_id = None   # Issued in the handshake to walls that can resume
+        self.resume_token = None
+        self.out_id = 0          # Id of the last RESUMABLE_TYPES packet sent
+        self.unacked = deque()   # (id, type, payload, data, trace id) the wall has not played yet
+        self.unacked_bytes = 0
+        self.ack_lock = threading.Lock()
+        self.waiting_for = ()    # Packet types receive() is blocked on
+        self.resume_cond = threading.Condition()
+        self.expired = False     # Grace period ran out; the session can no longer be resumed
+        self.resumed_into = None # Parked session this connection was handed to
+
+        self.packets = self._dispatcher(conn)
+
+    def _dispatcher(self, conn):
+        packets = Dispatcher(conn, name=f"wall{self.id}")
+        packets.on("SOIL_DATA", lambda msg: self.update_soil(msg.get('payload', {})))
+        packets.on("TRACE", lambda msg: record_client_trace(msg.get('payload', {})))
+        packets.on("INTERRUPT", lambda msg: self.interrupt(msg.get('payload', {})))
+        packets.on("ACK", lambda msg: self.acknowledge(msg.get('payload', {}).get('id')))
+        packets.on("GET_STATS", self.send_stats)
+        packets.on("AUDIO_END", self.end_upload)
+        packets.sink("AUDIO_FRAME", self.upload_sink)
+        return packets
+
+    def log(self, text):
+        print(f"[Wall {self.id}] {text}")
+
+    def settimeout(self, seconds):
+        self.timeout = seconds
+
+    def save_debug_audio(self, name, data):
+        """Audio stays in memory; files are only written when debugging"""
+        if DEBUG_AUDIO_FILES and data:
+            with open(f"{name}_{self.id}", "wb") as f:
+                f.write(data)
+
+    def send(self, msg_type, payload=None, data=None):
+        """Sends one packet; safe to call from the reader and chunk sender threads too"""
+        trace = self.trace
+        audio = msg_type.startswith("SPEAK") and data
+        if audio:
+            self.save_debug_audio(f"reply.{(payload or {}).get('codec', 'mp3')}", data)
+        start = time.monotonic()
+        with self.send_lock:
+            if self.session_id and msg_type in RESUMABLE_TYPES:
+                payload = self.keep_for_replay(msg_type, payload, data, trace and trace.id)
+            send_packet(self.conn, msg_type, payload=payload, data=data,
+                        trace=trace and trace.id, binary=self.binary)
+        if not audio: return
+        METRICS.observe("send", time.monotonic() - start)
+        if trace:
+            trace.mark("first_audio_sent")
+            trace.mark("last_audio_sent", first=False)
+
+    def start_trace(self, trace_id=None):
+        self.trace = TurnTrace(trace_id)
+        return self.trace
+
+    def mark(self, name, first=True):
+        if self.trace: self.trace.mark(name, first)
+
+    def end_trace(self):
+        if self.trace: self.trace.finish(self)
+        self.trace = None
+
+    def handshake(self):
+        """Agrees on audio codecs with the wall's HELLO.
+
+        Clients that predate the handshake send nothing (or go straight to
+        PIR_TRIGGER); they keep raw PCM uplink and MP3 downlink.
+        """
+        # The reader thread is not running yet, so this read is on the socket itself
+        previous = self.conn.gettimeout()
+        self.conn.settimeout(HELLO_TIMEOUT)
+        msg = receive_packet(self.conn)
+        self.conn.settimeout(previous)
+        if not isinstance(msg, dict):
+            if msg is None: return False
+            self.log("[CODEC] No HELLO; using PCM up / MP3 down")
+            return True
+        if msg.get('type') != 'HELLO':
+            self.packets.route(msg)
+            return True
+        offer = msg.get('payload', {})
+        ours = server_codecs()
+        self.uplink = negotiate_codec(offer.get('uplink'), ours['uplink'], "pcm")
+        self.downlink = negotiate_codec(offer.get('downlink'), ours['downlink'], "mp3")
+        self.binary = BINARY_HEADERS and "binary" in (offer.get('headers') or [])
+        self.wants_ready = bool(offer.get('ready'))
+        self.wall_id = str(offer.get('wall_id') or self.wall_id)
+        if offer.get('resume'):
+            parked = RESUMABLE_SESSIONS.get(offer.get('session_id'))
+            token = str(offer.get('resume_token') or "")
+            if parked and hmac.compare_digest(parked.resume_token, token) and parked.attach(self, offer.get('last_id')):
+                self.resumed_into = parked
+                return True
+            self.session_id, self.resume_token = secrets.token_hex(8), secrets.token_hex(16)
+            with RESUMABLE_LOCK: RESUMABLE_SESSIONS[self.session_id] = self
+        self.log(f"[CODEC] Uplink {self.uplink}, downlink {self.downlink}, "
+                 f"{'binary' if self.binary else 'JSON'} headers")
+        ack = {"uplink": self.uplink, "downlink": self.downlink, "server_codecs": ours,
+               "header": "binary" if self.binary else "json", "ready": SERVER_READY.is_set()}
+        if self.session_id:
+            ack.update({"session_id": self.session_id, "resume_token": self.resume_token, "resumed": False})
+        self.send("HELLO_ACK", payload=ack)
+        return True
+
+    def wait_ready(self):
+        """Holds the wall until warm-up is done; walls that asked for it get a READY.
+        False if the server shut down first."""
+        if not SERVER_READY.is_set():
+            self.log(">> [STARTUP] Still warming up; the wall waits for READY")
+            while not SERVER_READY.wait(0.5):
+                if SHUTTING_DOWN.is_set(): return False
+        if self.wants_ready:
+            self.send("READY", payload={"warmup": WARMUP_RESULTS})
+        return True
+
+    def keep_for_replay(self, msg_type, payload, data, trace_id):
+        """Numbers a packet and keeps it until the wall acknowledges it (send_lock held)"""
+        self.out_id += 1
+        payload = dict(payload or {}, id=self.out_id)
+        with self.ack_lock:
+            self.unacked.append((self.out_id, msg_type, payload, data, trace_id))
+            self.unacked_bytes += len(data or b"")
+            while self.unacked_bytes > RESUME_BUFFER_BYTES and len(self.unacked) > 1:
+                self.unacked_bytes -= len(self.unacked.popleft()[3] or b"")
+        return payload
+
+    def acknowledge(self, packet_id):
+        """ACK from the wall: everything up to packet_id has been played (or dropped)"""
+        if not isinstance(packet_id, int): return
+        with self.ack_lock:
+            while self.unacked and self.unacked[0][0] <= packet_id:
+                self.unacked_bytes -= len(self.unacked.popleft()[3] or b"")
+
+    def wait_resume(self, lost):
+        """After the dispatcher `lost` hung up: waits up to RESUME_GRACE for the
+        wall to come back. True if the session now has a new connection."""
+        if not self.session_id: return False
+        with self.resume_cond:
+            if self.packets is lost and not self.expired and not SHUTTING_DOWN.is_set():
+                self.log(f">> [RESUME] Connection lost; keeping the session for {RESUME_GRACE}s")
+                self.resume_cond.wait_for(lambda: self.packets is not lost or SHUTTING_DOWN.is_set(),
+                                          RESUME_GRACE)
+            if self.packets is lost:
+                self.expired = True
+                self.log(">> [RESUME] The wall did not come back")
+                return False
+            return True
+
+    def attach(self, other, last_id):
+        """Moves this session onto the connection `other` just shook hands on.
+
+        The old socket is shut down first, which ends its reader and any send
+        stuck on it. Packets the wall has not acknowledged are replayed.
+        """
+        with self.resume_cond:
+            if self.expired: return False
+            try: self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            with self.send_lock:
+                self.close()
+                self.conn, self.addr = other.conn, other.addr
+                self.uplink, self.downlink = other.uplink, other.downlink
+                self.binary, self.wants_ready = other.binary, other.wants_ready
+                # A half-sent utterance is recorded again (close() dropped it)
+                self.acknowledge(last_id)
+                with self.ack_lock: replay = list(self.unacked)
+                # Waiting for the visitor's answer with nothing left to play: the wall records straight away
+                listening = "AUDIO_END" in self.waiting_for and not any(
+                    t == "SPEAK" or (t == "SPEAK_CHUNK" and p.get('final')) for _, t, p, _, _ in replay)
+                send_packet(self.conn, "HELLO_ACK", binary=self.binary, payload={
+                    "uplink": self.uplink, "downlink": self.downlink, "server_codecs": server_codecs(),
+                    "header": "binary" if self.binary else "json", "ready": SERVER_READY.is_set(),
+                    "session_id": self.session_id, "resume_token": self.resume_token,
+                    "resumed": True, "listening": listening})
+                for _, msg_type, payload, data, trace_id in replay:
+                    send_packet(self.conn, msg_type, payload=payload, data=data, trace=trace_id, binary=self.binary)
+            self.log(f">> [RESUME] Wall is back from {self.addr}; replayed {len(replay)} packet(s)"
+                     f"{', listening' if listening else ''}")
+            self.packets = self._dispatcher(self.conn)
+            self.start_reader()
+            self.resume_cond.notify_all()
+        self.subscribe_soil()
+        return True
+
+    def start_reader(self):
+        """Hands the receive side of the socket to the dispatcher thread"""
+        self.conn.settimeout(SOCKET_TIMEOUT)
+        self.packets.start()
+
+    def receive(self, *types):
+        """Oldest packet of one of types, waiting up to the session timeout.
+        Returns the packet, "TIMEOUT", or None once the wall has hung up
+        (and, for a resumable wall, not come back within RESUME_GRACE)"""
+        while True:
+            packets = self.packets
+            self.waiting_for = types
+            msg = packets.get(types, self.timeout)
+            if msg is not None or not self.wait_resume(packets): break
+        self.waiting_for = ()
+        if isinstance(msg, dict) and msg.get('type') == 'AUDIO':
+            self.save_debug_audio("input.wav", msg.get('data'))
+        return msg
+
+    def subscribe_soil(self):
+        self.send("SUBSCRIBE_SOIL", payload={"interval": SOIL_PUSH_INTERVAL, "delta": SOIL_PUSH_DELTA})
+
+    def update_soil(self, payload):
+        try: self.soil = int(payload.get('soil', 0))
+        except (TypeError, ValueError): return
+        self.soil_time = time.time()
+        self.soil_event.set()
+        FLEET.record(self.wall_id, self.soil, self.soil_time)
+
+    def soil_age(self):
+        return time.time() - self.soil_time if self.soil is not None else None
+
+    def current_soil(self):
+        """Cached soil reading; only asks the client when it is older than SOIL_FRESHNESS"""
+        age = self.soil_age()
+        if age is not None and age <= SOIL_FRESHNESS:
+            self.log(f">> [Logic] Soil {self.soil}% (cached, {age:.1f}s old)")
+            return self.soil
+        self.log(">> [Logic] Soil reading is stale. Asking the client...")
+        self.soil_event.clear()
+        self.send("GET_SOIL")
+        self.soil_event.wait(self.soil_timeout)  # Set by the reader when SOIL_DATA arrives
+        return self.soil
+
+    def upload_sink(self, header):
+        """Where an AUDIO_FRAME body goes: the utterance being uploaded (reader thread)"""
+        if self.upload is None:
+            self.upload = UploadStream()
+        return self.upload.sink(header)
+
+    def end_upload(self, msg):
+        """AUDIO_END takes the finished utterance with it; the next frame starts a new one"""
+        msg['upload'] = self.upload
+        self.upload = None
+        return msg
+
+    def send_stats(self, msg):
+        self.send("STATS", payload={"stages": METRICS.snapshot(), "pools": stage_stats(),
+                                    "text": METRICS.prometheus()})
+
+    def new_turn(self):
+        self.turn += 1
+        self.cancelled.clear()
+        self.fallback = False
+        return self.turn
+
+    def interrupt(self, payload):
+        """The visitor talked over the current reply: stop working on it"""
+        if payload.get('turn') != self.turn or self.cancelled.is_set(): return
+        self.log(f">> [BARGE-IN] Turn {self.turn} interrupted; cancelling the reply")
+        self.cancelled.set()
+
+    def tts(self, text):
+        """(audio, codec metadata) for text in this wall's downlink codec"""
+        start = time.monotonic()
+        result = generate_tts(text, self.downlink)
+        METRICS.observe("tts", time.monotonic() - start)
+        return result
+
+    def speak(self, text, msg_type="SPEAK"):
+        """Synthesizes text (on the TTS stage) and sends it as audio"""
+        data, meta = TTS_STAGE.run(self.tts, text)
+        self.send(msg_type, payload={"turn": self.turn, **meta}, data=data)
+
+    def close(self):
+        try: self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        try: self.conn.close()
+        except OSError: pass
+        # Utterances still on their way in are never transcribed now
+        self.packets.discard("AUDIO_END")
+        if self.upload: self.upload.close()
+        self.upload = None
+
+# --- CONVERSATION CONTEXT ---
+
+def estimate_tokens(text):
+    return len(text) // 4 + 4
+
+class ConversationContext:
+    """Builds the message list for ollama.chat within a token budget.
+
+    The prompt is always: system prompt, running summary, recent turns, and
+    only the newest soil note just before the last user turn. Old turns are
+    folded into the summary by a background thread, so a long chat costs
+    the same per turn as a short one. Keeping everything before the newest
+    turn unchanged from one call to the next lets the model reuse its
+    cached prompt instead of re-reading the whole history.
+    """
+
+    def __init__(self, system_prompt, budget=CONTEXT_TOKEN_BUDGET, keep=CONTEXT_KEEP_MESSAGES):
+        self.system_prompt = system_prompt
+        self.budget = budget
+        self.keep = keep
+        self.summary = ""
+        self.turns = []        # user/assistant messages not yet summarized
+        self.soil_note = None
+        self.fleet_note = None
+        self.summarizing = False
+        self.lock = threading.Lock()
+
+    def add(self, role, content):
+        with self.lock:
+            self.turns.append({'role': role, 'content': content})
+        if role == 'assistant':
+            self._maybe_summarize()
+
+    def set_soil(self, value):
+        """Replaces the previous soil reading instead of piling up notes"""
+        with self.lock:
+            self.soil_note = f"SYSTEM NOTE: Current Soil Moisture is {value}%."
+
+    def set_fleet(self, note):
+        """Fleet drying forecast, set once per chat so the prompt prefix stays the same"""
+        with self.lock:
+            self.fleet_note = note
+
+    def _tokens(self, turns):
+        return sum(estimate_tokens(t['content']) for t in turns)
+
+    def messages(self):
+        with self.lock:
+            msgs = [{'role': 'system', 'content': self.system_prompt}]
+            if self.fleet_note:
+                msgs.append({'role': 'system', 'content': self.fleet_note})
+            if self.summary:
+                msgs.append({'role': 'system', 'content': f"Summary of the conversation so far: {self.summary}"})
+            turns = list(self.turns)
+            fixed = sum(estimate_tokens(m['content']) for m in msgs)
+            # If the summarizer is behind, drop the oldest turns rather than blow the budget
+            while len(turns) > self.keep and fixed + self._tokens(turns) > self.budget * 2:
+                turns.pop(0)
+            if self.soil_note:
+                at = len(turns) - 1 if turns and turns[-1]['role'] == 'user' else len(turns)
+                turns.insert(at, {'role': 'system', 'content': self.soil_note})
+            return msgs + turns
+
+    def _maybe_summarize(self):
+        with self.lock:
+            if self.summarizing or len(self.turns) <= self.keep: return
+            if self._tokens(self.turns) + estimate_tokens(self.summary) <= self.budget: return
+            old = self.turns[:-self.keep]
+            self.summarizing = True
+        threading.Thread(target=self._summarize, args=(old,), daemon=True).start()
+
+    def _summarize(self, old):
+        transcript = "\n".join(f"{t['role']}: {t['content']}" for t in old)
+        if self.summary:
+            transcript = f"Earlier summary: {self.summary}\n{transcript}"
+        try:
+            # Background work: behind every visitor's reply, and never shed
+            import ollama
+            with LLM_SCHEDULER.slot("summary", PRIORITY_BACKGROUND):
+                response = ollama.chat(model=LLM_MODEL, keep_alive=LLM_KEEP_ALIVE, messages=[
+                    {'role': 'system', 'content': SUMMARY_PROMPT},
+                    {'role': 'user', 'content': transcript}])
+            summary = response['message']['content'].strip()
+        except Exception as e:
+            print(f"[LLM] Summary failed: {e}")
+            summary = None
+        with self.lock:
+            if summary:
+                self.summary = summary
+                # Turns may have been added meanwhile; only drop the summarized ones
+                self.turns = self.turns[len(old):]
+            self.summarizing = False
+
+# --- LLM SCHEDULER ---
+
+PRIORITY_FIRST = 0       # First reply of a chat: the visitor has just walked up
+PRIORITY_REPLY = 1
+PRIORITY_BACKGROUND = 2  # Conversation summaries
+
+class LLMBusy(Exception):
+    """The model cannot start on this request within its latency SLO"""
+
+class LLMTicket:
+    def __init__(self, wall, priority):
+        self.wall = wall
+        self.priority = priority
+        self.granted = threading.Event()
+
+class LLMScheduler:
+    """Admission control in front of the single local ollama.
+
+    At most max_concurrent generations run at once. Waiting requests are
+    queued per wall and served round-robin across walls, first replies of a
+    chat ahead of later ones and summaries last. A request whose estimated
+    wait (requests ahead x recent generation time) is over its SLO, or that
+    is still waiting when the SLO runs out, raises LLMBusy so the caller can
+    answer with a fallback instead of keeping the visitor waiting.
+    """
+
+    def __init__(self, max_concurrent=LLM_MAX_CONCURRENT):
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.queues = {}          # priority -> OrderedDict(wall -> deque of tickets)
+        self.service_time = None  # Moving average of how long a generation holds its slot
+        self.completed = 0
+        self.shed = 0
+        self.busy = deque()       # (finished at, seconds held) within STAGE_WINDOW
+        self.started = time.time()
+        self.last_used = 0.0      # When a generation last gave its slot back
+        self.lock = threading.Lock()
+
+    def _waiting(self, up_to=None):
+        return sum(len(tickets) for priority, walls in self.queues.items()
+                   if up_to is None or priority <= up_to for tickets in walls.values())
+
+    def estimated_wait(self, priority):
+        # Caller holds the lock
+        if self.service_time is None: return 0.0
+        ahead = self._waiting(priority) + self.active - self.max_concurrent + 1
+        return max(0, ahead) * self.service_time / self.max_concurrent
+
+    def _dispatch(self):
+        # Caller holds the lock
+        while self.active < self.max_concurrent:
+            walls = next((self.queues[p] for p in sorted(self.queues) if self.queues[p]), None)
+            if walls is None: return
+            wall, tickets = next(iter(walls.items()))
+            ticket = tickets.popleft()
+            del walls[wall]
+            if tickets: walls[wall] = tickets  # To the back: the other walls go first
+            self.active += 1
+            ticket.granted.set()
+
+    def _remove(self, ticket):
+        # Caller holds the lock
+        walls = self.queues[ticket.priority]
+        walls[ticket.wall].remove(ticket)
+        if not walls[ticket.wall]: del walls[ticket.wall]
+
+    def _admit(self, wall, priority, slo):
+        """Waits for a generation slot; returns the seconds spent waiting"""
+        submitted = time.monotonic()
+        ticket = LLMTicket(wall, priority)
+        with self.lock:
+            estimate = self.estimated_wait(priority)
+            if slo is not None and estimate > slo:
+                self.shed += 1
+                raise LLMBusy(f"estimated wait {estimate:.1f}s is over the {slo}s SLO")
+            self.queues.setdefault(priority, OrderedDict()).setdefault(wall, deque()).append(ticket)
+            self._dispatch()
+        if not ticket.granted.wait(slo):
+            with self.lock:
+                if not ticket.granted.is_set():
+                    self._remove(ticket)
+                    self.shed += 1
+                    raise LLMBusy(f"no slot within the {slo}s SLO")
+        waited = time.monotonic() - submitted
+        METRICS.observe("llm_queue", waited)
+        return waited
+
+    def _release(self, held, measure):
+        with self.lock:
+            self.active -= 1
+            self.completed += 1
+            self.last_used = time.time()
+            self.busy.append((self.last_used, held))
+            if measure:
+                self.service_time = held if self.service_time is None else 0.8 * self.service_time + 0.2 * held
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, wall, priority=PRIORITY_REPLY, measure=True):
+        """Holds one of the model's generation slots for the with-block.
+        Raises LLMBusy if a visitor's reply would miss LLM_SLO_SECONDS;
+        background requests wait as long as it takes. measure=False keeps
+        a short request (a warm-up) out of the wait estimate."""
+        slo = None if priority == PRIORITY_BACKGROUND else LLM_SLO_SECONDS
+        self._admit(wall, priority, slo)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - start, measure)
+
+    def stats(self):
+        """Same shape as Stage.stats(), plus how many requests were shed"""
+        now = time.time()
+        with self.lock:
+            while self.busy and self.busy[0][0] < now - STAGE_WINDOW:
+                self.busy.popleft()
+            window = min(STAGE_WINDOW, now - self.started) or 1e-9
+            busy = sum(held for _, held in self.busy)
+            waiting = self._waiting()
+            return {"kind": "ollama", "workers": self.max_concurrent, "in_flight": self.active + waiting,
+                    "queued": waiting, "completed": self.completed, "shed": self.shed,
+                    "utilization": round(min(1.0, busy / (self.max_concurrent * window)), 3)}
+
+LLM_SCHEDULER = LLMScheduler()
+
+def llm_priority(session):
+    return PRIORITY_FIRST if session.replies == 0 else PRIORITY_REPLY
+
+def llm_fallback(session, question, reason):
+    """What to say when the model is too busy or failing: a cached answer to
+    the same question if there is one, else a short canned line"""
+    entry = ANSWER_CACHE.peek(question, soil_bucket(session.soil))
+    if entry is not None:
+        text = entry.text
+    elif isinstance(reason, LLMBusy):
+        text = random.choice(LLM_BUSY_TEXTS)
+    else:
+        text = THINKING_ERROR_TEXT
+    session.log(f"[LLM] {reason}; answering with a {'cached' if entry else 'canned'} reply")
+    session.fallback = True
+    return text
+
+# --- INTRO SPECULATION ---
+
+WARMUP_LOCK = threading.Lock()
+
+def warm_llm():
+    """Loads the model and primes ollama's prompt cache with the system
+    prompt, unless a request has used the model recently.
+    False if loading failed, None if there was nothing to do."""
+    if time.time() - LLM_SCHEDULER.last_used < LLM_WARMUP_IDLE: return
+    if not WARMUP_LOCK.acquire(blocking=False): return  # Another wall is already at it
+    try:
+        import ollama
+        start = time.monotonic()
+        with LLM_SCHEDULER.slot("warmup", PRIORITY_BACKGROUND, measure=False):
+            if time.time() - LLM_SCHEDULER.last_used < LLM_WARMUP_IDLE: return  # Used while we queued
+            ollama.chat(model=LLM_MODEL, messages=[{'role': 'system', 'content': SYSTEM_PROMPT}],
+                        keep_alive=LLM_KEEP_ALIVE, options={"num_predict": 1})
+        print(f">> [LLM] Model warmed up in {time.monotonic() - start:.1f}s")
+        return True
+    except Exception as e:
+        print(f">> [LLM] Warm-up failed: {e}")
+        return False
+    finally:
+        WARMUP_LOCK.release()
+
+class IntroSpeculation:
+    """Audio the wall will probably need after the intro, made while it plays.
+
+    The start message depends on the soil re-check, so on a dry wall it is
+    rendered for the latest pushed reading and again whenever that changes;
+    the reminder and goodbye are rendered once. finish() waits for the
+    message actually spoken and drops the cache entries this made for
+    readings that never came to pass. The model is warmed up alongside.
+    """
+
+    def __init__(self, session, soil):
+        self.session = session
+        self.soil = soil
+        self.was_dry = soil < SOIL_DRY_THRESHOLD
+        self.jobs = {}        # text -> Future of the TTS stage job
+        self.created = {}     # text -> cache keys that did not exist before the job
+        self.dropped = set()  # Texts nobody will speak; their jobs skip synthesis
+        self.stop = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        threading.Thread(target=warm_llm, daemon=True).start()
+
+    def start_message(self, soil):
+        return build_start_message(self.was_dry, soil) + LISTENING_TEXT
+
+    def _render(self, text):
+        if text in self.dropped: return None
+        return self.session.tts(text)
+
+    def _submit(self, text):
+        if text in self.jobs: return
+        clean_text = clean_text_for_audio(text)
+        keys = {TTSCache.key(clean_text, codec=codec) for codec in ("mp3", self.session.downlink)}
+        self.created[text] = [key for key in keys if not TTS_CACHE.contains(key)]
+        self.jobs[text] = TTS_STAGE.submit(self._render, text)
+
+    def _run(self):
+        for text in (self.start_message(self.soil), REMINDER_TEXT, EXIT_TEXT):
+            self._submit(text)
+        if not self.was_dry: return  # "Great. I am ready." whatever the soil does
+        while not self.stop.wait(SPECULATE_POLL) and not self.session.packets.closed:
+            if self.session.soil is not None:
+                self._submit(self.start_message(self.session.soil))
+
+    def finish(self, used):
+        """Stops speculating; returns once the audio for `used` (the text
+        about to be spoken) is cached, if it was one of the guesses"""
+        self.stop.set()
+        if self.thread: self.thread.join()
+        for text, future in self.jobs.items():
+            if text in (used, REMINDER_TEXT, EXIT_TEXT): continue  # Fixed phrases serve the next visit too
+            self.dropped.add(text)
+            for key in self.created[text]:
+                future.add_done_callback(lambda f, key=key: TTS_CACHE.discard(key))
+        future = self.jobs.get(used)
+        if future is not None:
+            try: future.result()
+            except Exception: pass  # speak() reports it when it tries again
+        self.session.log(f">> [SPECULATE] {'Hit' if future is not None else 'Miss'} on '{used[:30]}...' "
+                         f"({len(self.jobs)} guesses, {len(self.dropped)} dropped)")
+
+# --- STREAMING REPLIES ---
+
+# A sentence ends at . ! or ? (plus closing quotes/brackets) followed by whitespace
+SENTENCE_END = re.compile(r'[.!?]+["\')\]]*\s+')
+
+def split_sentences(text):
+    """Splits off complete sentences. Returns (sentences, unfinished_remainder)"""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        sentences.append(text[start:match.end()].strip())
+        start = match.end()
+    return sentences, text[start:]
+
+def _send_chunks(session, pending):
+    """Sends synthesized sentences in order as they become ready"""
+    seq = 0
+    turn = session.turn
+    while True:
+        future = pending.get()
+        if future is None: break
+        if session.cancelled.is_set():
+            future.cancel()  # Nobody will hear it; skip synthesis if not started
+            continue
+        try:
+            data, meta = future.result()
+        except Exception as e:
+            session.log(f"TTS Error: {e}")
+            data = None
+        if data and not session.cancelled.is_set():
+            session.send("SPEAK_CHUNK", payload={"seq": seq, "turn": turn, "final": False, **meta}, data=data)
+            seq += 1
+    # Final marker: client records once everything queued has played.
+    # After a barge-in the client is already recording.
+    if not session.cancelled.is_set():
+        session.send("SPEAK_CHUNK", payload={"seq": seq, "turn": turn, "final": True})
+
+def stream_reply(session, messages, question=""):
+    """Streams the LLM reply to the client one sentence at a time.
+
+    Each finished sentence is cleaned and synthesized on the TTS pool while
+    the model keeps generating; a sender thread ships the audio in order as
+    SPEAK_CHUNK packets. If the visitor interrupts, generation stops and
+    unsent sentences are dropped. Returns the reply text generated so far.
+    """
+    pending = queue.Queue()
+    sender = threading.Thread(target=_send_chunks, args=(session, pending), daemon=True)
+    sender.start()
+
+    def submit(sentence):
+        if not clean_text_for_audio(sentence) or session.cancelled.is_set(): return
+        pending.put(TTS_STAGE.submit(session.tts, sentence))
+
+    reply = ""
+    buffer = ""
+    stream = None
+    session.mark("llm_start")
+    try:
+        with LLM_SCHEDULER.slot(session.id, llm_priority(session)):
+            session.mark("llm_slot")
+            try:
+                import ollama
+                stream = ollama.chat(model=LLM_MODEL, messages=messages, stream=True, keep_alive=LLM_KEEP_ALIVE)
+                for part in stream:
+                    if session.cancelled.is_set(): break
+                    session.mark("llm_first_token")
+                    token = part['message']['content']
+                    reply += token
+                    buffer += token
+                    sentences, buffer = split_sentences(buffer)
+                    for sentence in sentences:
+                        submit(sentence)
+            finally:
+                # Closing the stream drops the HTTP request, so ollama stops generating
+                # and the slot goes to the next wall
+                if stream is not None and hasattr(stream, "close"): stream.close()
+        if not session.cancelled.is_set(): session.mark("llm_end")
+        submit(buffer)
+    except Exception as e:
+        if not isinstance(e, LLMBusy): session.log(f"LLM Error: {e}")
+        if not reply.strip():
+            reply = llm_fallback(session, question, e)
+            submit(reply)
+    finally:
+        pending.put(None)
+        sender.join()
+    session.replies += 1
+    return reply.strip()
+
 # --- LOGIC ---
 
-def wait_for_user_enter(conn):
+def wait_for_user_enter(session):
     """Waits for USER_ENTER packet from Client"""
-    print(">> [SERVER] Waiting for Client to press Enter...")
+    session.log(">> [SERVER] Waiting for Client to press Enter...")
     
-    # INCREASED TIMEOUT to 40s (Allows user to listen to long intro)
-    conn.settimeout(40.0) 
+    # INCREASED TIMEOUT (Allows user to listen to long intro)
+    session.settimeout(session.enter_timeout)
 
     # Attempt 1
     try:
         start_time = time.time()
-        while time.time() - start_time < 40:
-            msg = receive_packet(conn)
+        while time.time() - start_time < session.enter_timeout:
+            msg = session.receive("USER_ENTER")
             if msg == "TIMEOUT": continue
-            if msg and msg.get('type') == 'USER_ENTER':
-                print(">> [SERVER] User pressed Enter! Starting chat.")
+            if not msg: return False
+            if msg.get('type') == 'USER_ENTER':
+                session.log(">> [SERVER] User pressed Enter! Starting chat.")
                 return True
     except: pass
     
     # Reminder (Using SPEAK_INTRO so client DOES NOT record)
-    print(">> Timeout 1. Sending Reminder.")
-    f = generate_tts(REMINDER_TEXT)
-    send_packet(conn, "SPEAK_INTRO", file_path=f)
+    session.log(">> Timeout 1. Sending Reminder.")
+    session.speak(REMINDER_TEXT, msg_type="SPEAK_INTRO")
     
     # Attempt 2
     try:
         start_time = time.time()
-        while time.time() - start_time < 30:
-            msg = receive_packet(conn)
+        while time.time() - start_time < session.reminder_timeout:
+            msg = session.receive("USER_ENTER")
             if msg == "TIMEOUT": continue
-            if msg and msg.get('type') == 'USER_ENTER':
-                print(">> [SERVER] User pressed Enter! Starting chat.")
+            if not msg: return False
+            if msg.get('type') == 'USER_ENTER':
+                session.log(">> [SERVER] User pressed Enter! Starting chat.")
                 return True
     except: pass
 
     return False
 
-def chat_mode(conn, custom_intro=None):
-    print(">> --- CHAT LOOP STARTED ---")
-    system_prompt = ("You are a sentient Vertical Green Wall and you are a living, "
-    "breathing plant and you are chatting with a human via voice. " 
-    "Keep your responses concise and friendly. " 
-    "also you can mention your need for water if your soil is dry." 
-    "you can refer to yourself as a plant wall or green wall.")
-    
-    history = [{'role': 'system', 'content': system_prompt}]
+def chat_mode(session, custom_intro=None):
+    session.log(">> --- CHAT LOOP STARTED ---")
+    session.context = ConversationContext(SYSTEM_PROMPT)
+    session.context.set_fleet(FLEET.note(session.wall_id))
+    session.replies = 0
+    context = session.context
+    questions = 0  # Only the first question of a chat means the same for every visitor
     
-    conn.settimeout(60.0) # Long timeout for conversation
+    session.settimeout(session.chat_timeout) # Long timeout for conversation
 
     if custom_intro:
-        greeting = custom_intro + " I am listening."
+        greeting = custom_intro + LISTENING_TEXT
     else:
-        greeting = "Hello! I am listening. Please speak now."
+        greeting = DEFAULT_GREETING
 
-    print(f"Wall: {greeting}")
-    f = generate_tts(greeting)
-    send_packet(conn, "SPEAK", file_path=f) 
-    history.append({'role': 'assistant', 'content': greeting})
+    session.log(f"Wall: {greeting}")
+    session.packets.discard("AUDIO", "AUDIO_END")  # Nothing recorded before the greeting counts
+    session.new_turn()
+    session.speak(greeting)
+    context.add('assistant', greeting)
 
     while True:
-        print(">> Waiting for AUDIO from client...")
-        msg = receive_packet(conn)
+        session.end_trace()  # Everything for the previous turn has been sent
+        if session.upload is None:
+            session.log(">> Waiting for AUDIO from client...")
+        # Frames stream into session.upload on the reader thread as they arrive
+        msg = session.receive("AUDIO", "AUDIO_END")
         
         if not msg: break
         if msg == "TIMEOUT":
-            print(">> Timeout waiting for audio")
+            session.log(">> Timeout waiting for audio")
             break
 
-        if msg.get('type') == 'AUDIO':
-            user_text = transcribe_audio("input.wav")
-            print(f"User: {user_text}")
+        if msg.get('type') in ('AUDIO', 'AUDIO_END'):
+            upload = msg.get('upload')
+            session.trace = (upload and upload.trace) or TurnTrace(msg.get('trace'))
+            session.mark("upload_end")
+            session.mark("asr_start")
+            if msg['type'] == 'AUDIO_END':
+                user_text = upload.finish().text if upload else ""
+            # The client drops recordings with no speech and sends an empty AUDIO
+            elif msg.get('file_size', 0) > 0:
+                meta = msg.get('payload', {})
+                user_text = transcribe_audio(msg['data'], meta.get('codec', "wav"),
+                                             meta.get('rate', UPLOAD_SAMPLE_RATE))
+            else:
+                user_text = ""
+            session.mark("asr_end")
+            session.log(f"User: {user_text}")
 
             if not user_text:
-                f = generate_tts("I didn't hear anything. Please try again.")
-                send_packet(conn, "SPEAK", file_path=f)
+                session.new_turn()
+                session.speak(NO_SPEECH_TEXT)
                 continue
 
             if any(w in user_text.lower() for w in ["bye", "stop", "exit"]):
-                f = generate_tts(EXIT_TEXT)
-                send_packet(conn, "SPEAK", file_path=f)
+                session.new_turn()  # After a barge-in the goodbye must not carry the dropped turn
+                session.speak(EXIT_TEXT)
                 break
             
             # Real-time Soil Check during Chat
-            if any(w in user_text.lower() for w in ["soil", "moisture", "water", "status"]):
-                print(">> [Logic] Checking fresh sensors...")
-                send_packet(conn, "GET_SOIL")
-                conn.settimeout(5.0)
-                dmsg = receive_packet(conn)
-                conn.settimeout(60.0)
-                if dmsg and dmsg.get('type') == 'SOIL_DATA':
-                    val = dmsg['payload'].get('soil', 0)
-                    history.append({'role': 'system', 'content': f"SYSTEM NOTE: Current Soil Moisture is {val}%."})
-
-            history.append({'role': 'user', 'content': user_text})
+            soil_question = any(w in user_text.lower() for w in ["soil", "moisture", "water", "status"])
+            if soil_question:
+                session.log(">> [Logic] Checking fresh sensors...")
+                val = session.current_soil()
+                if val is not None:
+                    context.set_soil(val)
+
+            context.add('user', user_text)
+            questions += 1
+            # Follow-ups depend on the conversation and soil answers quote the live
+            # reading, so neither is looked up in or added to the answer cache
+            cache_key = user_text if questions == 1 and not soil_question else ""
             
+            session.new_turn()
+            cached = ANSWER_CACHE.lookup(cache_key, soil_bucket(session.soil))
+            if cached:
+                speak_cached_answer(session, cached)
+                context.add('assistant', cached.text)
+                continue
+
+            if STREAM_REPLIES:
+                ai_text = stream_reply(session, context.messages(), cache_key)
+                session.log(f"Wall: {ai_text}")
+                context.add('assistant', ai_text)
+                remember_answer(session, cache_key, ai_text)
+                continue
+
+            session.mark("llm_start")
             try:
-                response = ollama.chat(model='gemma2:2b', messages=history)
+                import ollama
+                with LLM_SCHEDULER.slot(session.id, llm_priority(session)):
+                    session.mark("llm_slot")
+                    response = ollama.chat(model=LLM_MODEL, messages=context.messages(), keep_alive=LLM_KEEP_ALIVE)
                 ai_text = response['message']['content']
-            except: ai_text = "I am having trouble thinking."
+            except Exception as e:
+                ai_text = llm_fallback(session, cache_key, e)
+            session.replies += 1
+            session.mark("llm_first_token")
+            session.mark("llm_end")
+            if session.cancelled.is_set(): continue  # The visitor is already speaking again
 
-            print(f"Wall: {ai_text}")
-            history.append({'role': 'assistant', 'content': ai_text})
+            session.log(f"Wall: {ai_text}")
+            context.add('assistant', ai_text)
             
-            f = generate_tts(ai_text)
-            send_packet(conn, "SPEAK", file_path=f)
+            session.speak(ai_text)
+            remember_answer(session, cache_key, ai_text)
+    session.end_trace()
 
-def run_session(conn, initial_soil_level):
+def run_session(session, initial_soil_level):
     try: current_soil = int(initial_soil_level)
     except: current_soil = 0
 
-    is_dry = current_soil < 30
-    intro_audio_text = BASE_INTRO
+    is_dry = current_soil < SOIL_DRY_THRESHOLD
 
     # --- STEP 1: INITIAL ANALYSIS ---
     if is_dry:
-        print(f">> [Logic] Soil is DRY ({current_soil}%). Asking for water.")
-        intro_audio_text += f"My soil moisture is low at {current_soil} percent. It is dry. Could you please help water me? "
-        intro_audio_text += PROMPT_TEXT 
+        session.log(f">> [Logic] Soil is DRY ({current_soil}%). Asking for water.")
     else:
-        print(f">> [Logic] Soil is WET ({current_soil}%). Ready to chat.")
-        intro_audio_text += f"My soil moisture is a healthy {current_soil} percent. I do not need water. "
-        intro_audio_text += PROMPT_TEXT
+        session.log(f">> [Logic] Soil is WET ({current_soil}%). Ready to chat.")
+    intro_audio_text = build_intro_text(current_soil)
+
+    session.speak(intro_audio_text, msg_type="SPEAK_INTRO")
+    session.end_trace()
 
-    f = generate_tts(intro_audio_text)
-    send_packet(conn, "SPEAK_INTRO", file_path=f)
+    # Make the likely next outputs while the visitor listens
+    speculation = IntroSpeculation(session, current_soil) if SPECULATE_INTRO else None
+    if speculation: speculation.start()
 
     # --- STEP 2: WAIT FOR ENTER ---
-    if not wait_for_user_enter(conn):
-        f = generate_tts(EXIT_TEXT)
-        send_packet(conn, "SPEAK_INTRO", file_path=f)
-        send_packet(conn, "END_SESSION")
+    if not wait_for_user_enter(session):
+        if speculation: speculation.finish(EXIT_TEXT)
+        session.speak(EXIT_TEXT, msg_type="SPEAK_INTRO")
+        session.send("END_SESSION")
         return
 
     # --- STEP 3: RE-CHECK LOGIC ---
     custom_start_msg = ""
     
     if is_dry:
-        print(">> [Logic] User pressed enter. RE-CHECKING soil status...")
-        send_packet(conn, "GET_SOIL")
+        session.log(">> [Logic] User pressed enter. RE-CHECKING soil status...")
+        new_soil = session.current_soil()
+        if new_soil is None:
+            new_soil = current_soil
+        session.log(f">> [Logic] Fresh Soil Data: {new_soil}%")
         
-        conn.settimeout(5.0)
-        new_packet = receive_packet(conn)
-        conn.settimeout(60.0) 
-        
-        new_soil = current_soil 
-        if new_packet and new_packet.get('type') == 'SOIL_DATA':
-            new_soil = int(new_packet['payload'].get('soil', 0))
-            print(f">> [Logic] Fresh Soil Data: {new_soil}%")
-        
-        if new_soil < 30:
-            custom_start_msg = f"I see my soil is still dry at {new_soil} percent. Perhaps the water needs time to soak in. We can talk anyway."
-        else:
-            custom_start_msg = f"Thank you! I sense the water. My moisture is now {new_soil} percent. I feel much better."
+        custom_start_msg = build_start_message(True, new_soil)
     else:
-        custom_start_msg = "Great. I am ready."
+        custom_start_msg = build_start_message(False, current_soil)
+    if speculation: speculation.finish(custom_start_msg + LISTENING_TEXT)
 
     # --- STEP 4: START CHAT ---
-    chat_mode(conn, custom_intro=custom_start_msg)
-    send_packet(conn, "END_SESSION")
+    chat_mode(session, custom_intro=custom_start_msg)
+    session.send("END_SESSION")
 
 def clean_text_for_audio(text):
     # 1. Remove Asterisks (often used for *actions*)
@@ -266,29 +2444,141 @@ def clean_text_for_audio(text):
     # 3. Remove extra whitespace
     return " ".join(clean_text.split())
 
+# --- STARTUP ---
+
+SERVER_READY = threading.Event()
+SHUTTING_DOWN = threading.Event()  # Set on Ctrl+C: nothing waits for warm-up or a wall's return any more
+WARMUP_RESULTS = {}  # warm-up step -> seconds it took, or "failed" / "unfinished"
+
+def warm_asr():
+    """Loads the recognizer here and/or starts the worker processes (each loads its own).
+
+    Streamed uploads are fed to ASR.stream() in this process, so a backend
+    that decodes them incrementally (Vosk) is needed here even when whole
+    utterances go to worker processes.
+    """
+    if ASR_STAGE.kind == "process":
+        for future in [ASR_STAGE.submit(os.getpid) for _ in range(ASR_STAGE.workers)]:
+            future.result()
+    if ASR_STAGE.kind != "process" or ASR.stream_class is not ASRStream:
+        load_asr()
+
+def load_tts():
+    """Imports gTTS and reads the fixed phrases already cached on disk into memory"""
+    import gtts  # Most of the first synthesis is loading the library
+    for text in template_phrases():
+        key = TTSCache.key(clean_text_for_audio(text))
+        if TTS_CACHE.contains(key): TTS_CACHE.get(key, count=False)
+
+WARMUP_STEPS = {"asr": warm_asr, "llm": warm_llm, "tts": load_tts}
+
+def warm_up():
+    """Runs the first-use setup of every backend in parallel, then sets SERVER_READY.
+
+    Walls may connect meanwhile; they are held (and told) until it is done.
+    A step still running after STARTUP_TIMEOUT does not hold them any longer.
+    """
+    def run(name, step):
+        start = time.time()
+        try:
+            # A step that handles its own errors reports them by returning False
+            WARMUP_RESULTS[name] = "failed" if step() is False else round(time.time() - start, 1)
+        except Exception as e:
+            print(f">> [STARTUP] {name} warm-up failed: {e}")
+            WARMUP_RESULTS[name] = "failed"
+
+    threads = [threading.Thread(target=run, args=item, daemon=True) for item in WARMUP_STEPS.items()]
+    for t in threads: t.start()
+    deadline = time.time() + STARTUP_TIMEOUT
+    for t in threads: t.join(max(0, deadline - time.time()))
+    for name in WARMUP_STEPS:
+        WARMUP_RESULTS.setdefault(name, "unfinished")
+    SERVER_READY.set()
+    steps = ", ".join(f"{name} {result}{'s' if isinstance(result, float) else ''}"
+                      for name, result in WARMUP_RESULTS.items())
+    print(f">> [STARTUP] Ready for visitors {time.time() - PROCESS_START:.1f}s after start ({steps})")
+    if TTS_PREWARM:
+        prewarm_tts_cache()
+
+ACTIVE_SESSIONS = set()
+ACTIVE_LOCK = threading.Lock()
+RESUMABLE_SESSIONS = {}  # session_id -> WallSession, while its wall thread is running
+RESUMABLE_LOCK = threading.Lock()
+
+def handle_connection(conn, addr):
+    """Serves one wall for as long as its socket stays open"""
+    session = WallSession(conn, addr)
+    with ACTIVE_LOCK: ACTIVE_SESSIONS.add(session)
+    session.log(f"Connected: {addr}")
+    try:
+        if not session.handshake(): return
+        if session.resumed_into:
+            session.log(f"Handed over to wall {session.resumed_into.id} (resumed)")
+            return
+        session.start_reader()
+        if not session.wait_ready(): return
+        session.subscribe_soil()
+        while True:
+            session.settimeout(None)
+            msg = session.receive("PIR_TRIGGER")
+            if not msg: break
+
+            session.log("--- MOTION DETECTED ---")
+            session.start_trace(msg.get('trace')).mark("trigger")
+            session.update_soil(msg.get('payload', {}))
+            soil_val = msg.get('payload', {}).get('soil', 0)
+            run_session(session, soil_val)
+            # Motion and Enter during the visit belonged to the visitor just served
+            session.packets.discard("PIR_TRIGGER", "USER_ENTER")
+            session.log(f"--- END INTERACTION --- TTS cache: {TTS_CACHE.stats()}, "
+                        f"answer cache: {ANSWER_CACHE.stats()}")
+    except Exception as e:
+        session.log(f"Connection Error: {e}")
+    finally:
+        with ACTIVE_LOCK: ACTIVE_SESSIONS.discard(session)
+        if session.session_id:
+            with RESUMABLE_LOCK: RESUMABLE_SESSIONS.pop(session.session_id, None)
+        if session.resumed_into is None:
+            session.close()
+            session.log(f"Disconnected: {session.addr}")
+
 def start_server():
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind((HOST_IP, PORT))
-    server.listen(1)
-    print(f"Green Wall Brain Ready on {PORT}")
-    
-    while True:
-        try:
-            conn, addr = server.accept()
-            print(f"Connected: {addr}")
-            while True:
-                conn.settimeout(None)
-                msg = receive_packet(conn)
-                if not msg: break
-                
-                if msg != "TIMEOUT" and msg['type'] == "PIR_TRIGGER":
-                    print("\n--- MOTION DETECTED ---")
-                    soil_val = msg.get('payload', {}).get('soil', 0)
-                    run_session(conn, soil_val)
-                    print("--- END INTERACTION ---\n")
-        except Exception as e:
-            print(f"Connection Error: {e}")
+    server.listen(MAX_WALLS)
+    print(f"Green Wall Brain listening on {PORT} (up to {MAX_WALLS} walls) "
+          f"{time.time() - PROCESS_START:.1f}s after start; warming up...")
+
+    threading.Thread(target=warm_up, daemon=True).start()
+    threading.Thread(target=FLEET.run, daemon=True).start()
+    stats_server = start_stats_server() if STATS_PORT else None
+
+    # One worker thread per connected wall; extra walls wait for a free slot
+    # instead of blocking the accept loop.
+    pool = ThreadPoolExecutor(max_workers=MAX_WALLS, thread_name_prefix="wall")
+    try:
+        while True:
+            try:
+                conn, addr = server.accept()
+                pool.submit(handle_connection, conn, addr)
+            except OSError as e:
+                print(f"Accept Error: {e}")
+    except KeyboardInterrupt:
+        print("Shutting down...")
+    finally:
+        # Closing the sockets unblocks every wall thread so the pool can exit;
+        # sessions that would wait for their wall to reconnect end at once
+        SHUTTING_DOWN.set()
+        server.close()
+        if stats_server: stats_server.shutdown()
+        for stage in STAGES: stage.shutdown()
+        with ACTIVE_LOCK: sessions = list(ACTIVE_SESSIONS)
+        for session in sessions:
+            try: session.conn.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            with session.resume_cond: session.resume_cond.notify_all()
+        pool.shutdown(wait=True, cancel_futures=True)
 
 if __name__ == "__main__":
     start_server()
\ No newline at end of file
@@ -1,182 +1,1215 @@
+import asyncio
 import socket
 import os
+import sys
+import math
+import random
 import time
+import io
+import wave
 import json
 import serial
-import threading
+import shutil
 import struct
-import select
-import subprocess 
+import tempfile
+from array import array
+from collections import deque
+
+PROCESS_START = time.monotonic()
 
 # --- CONFIGURATION ---
 SERVER_IP = '192.168.137.1' 
 PORT = 5000
+WALL_ID = socket.gethostname()  # Name of this wall in the server's fleet telemetry
+BINARY_HEADERS = True        # Offer struct-packed packet headers in HELLO (JSON is always understood)
+RECONNECT_BASE_SECONDS = 0.5 # First retry delay; doubles with every failed attempt (randomized)
+RECONNECT_MAX_SECONDS = 30   # Longest wait between connection attempts
+SENSOR_SETTLE_SECONDS = 2    # PIR edges this soon after start are ignored while the sensor settles
 SERIAL_PORT = '/dev/ttyACM1' 
 BAUD_RATE = 9600
 PIR_COOLDOWN_SECONDS = 30
+SOIL_HISTORY_SIZE = 4096     # Soil readings kept in the telemetry ring buffer
+SOIL_TREND_SECONDS = 600     # Window used for soil min/mean/slope
 
 # Audio Settings
 MIC_DEVICE = "plughw:1,0"   
-# RECORD_CMD must include -N to block
-RECORD_CMD = ["arecord", "-D", MIC_DEVICE, "-d", "8", "-f", "S16_LE", "-r", "16000", "-t", "wav", "-N", "input.wav"]
-PLAY_CMD_LIST = ["mpg123", "-q", "response.mp3"] 
-
-# Shared State
-latest_pir_state = 0   
-prev_pir_state = 1     
-latest_soil_pct = 0 
-is_in_session = False 
-enter_key_pressed = False
-
-def input_monitor():
-    global enter_key_pressed
-    print(">> Keyboard Ready. Press ENTER when asked.")
-    while True:
-        try:
-            input() 
-            if is_in_session:
-                enter_key_pressed = True
-                print(">> [DEBUG] Enter Captured")
-        except: pass
-
-def read_arduino():
-    global latest_pir_state, latest_soil_pct
-    print(">> [SENSOR] Starting Arduino Listener...")
-    while True:
+# Long-lived capture stream (raw PCM on stdout); opened once and kept open
+CAPTURE_CMD = ["arecord", "-D", MIC_DEVICE, "-q", "-f", "S16_LE", "-r", "16000", "-c", "1", "-t", "raw"]
+# Long-lived player in remote-control mode; utterances are sent as LOAD commands
+PLAYER_REMOTE_CMD = ["mpg123", "-R"]
+# One-shot fallback if the remote player cannot be started (reads MP3 from stdin)
+PLAY_CMD_LIST = ["mpg123", "-q", "-"]
+# Utterances handed to the remote player live in RAM (tmpfs), not on the SD card
+PLAYER_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+PLAYER_MAX_SECONDS = 120  # Safety net if the player never reports the end of a track
+DEBUG_AUDIO_FILES = False  # Also save input.wav / response.mp3 for debugging
+
+# Audio codecs, offered to the server in this order of preference (HELLO)
+FFMPEG_CMD = "ffmpeg"                # Encodes Opus/FLAC uploads; without it uploads stay raw PCM
+UPLINK_CODECS = ["opus", "flac", "pcm"]
+DOWNLINK_CODECS = ["mp3", "pcm"]     # Put "pcm" first on a Pi Zero: nothing to decode, ~8x the bytes
+OPUS_BITRATE = "24k"                 # Plenty for 16 kHz speech recognition
+# Long-lived raw PCM player for "pcm" replies (the sample rate is appended)
+PCM_PLAY_CMD = ["aplay", "-q", "-t", "raw", "-f", "S16_LE", "-c", "1", "-r"]
+
+# Voice Activity Detection (VAD) recording
+RECORD_MODE = "vad"           # "vad" stops when the visitor stops talking, "fixed" always records RECORD_MAX_SECONDS
+UPLOAD_MODE = "stream"        # "stream" sends frames while recording (vad mode), "file" sends one WAV
+STREAM_FRAME_MS = 120         # Audio per AUDIO_FRAME packet when streaming
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+RECORD_MAX_SECONDS = 8        # Hard cap on one utterance
+VAD_NO_SPEECH_SECONDS = 5     # Give up if nobody starts talking
+VAD_TRAILING_SILENCE_MS = 800 # Silence that ends an utterance
+VAD_ENERGY_THRESHOLD = 500    # Minimum frame RMS that counts as speech
+VAD_NOISE_RATIO = 3.0         # Speech must also be this much louder than the room
+VAD_CALIBRATION_MS = 150      # Room noise measured at the start of each recording
+VAD_UNVOICED_ZCR = 0.25       # Quieter, hissy frames ("s", "f") keep speech going
+VAD_ONSET_FRAMES = 3          # Consecutive speech frames that start an utterance
+VAD_PREROLL_MS = 300          # Audio kept from just before the onset
+
+# Barge-in: the mic keeps listening while the wall talks, so a visitor can interrupt
+BARGE_IN = True
+BARGE_IN_CALIBRATION_MS = 600 # Start of each playback used to measure the wall's own voice in the mic
+BARGE_IN_NOISE_RATIO = 1.5    # Speech must be this much louder than the loudest frame of that
+BARGE_IN_ONSET_FRAMES = 8     # Consecutive speech frames (240 ms) that stop playback
+
+# --- TELEMETRY ---
+
+class TelemetryRing:
+    """Fixed-size ring buffer of timestamped sensor readings.
+
+    Timestamps and values live in two preallocated float arrays, so an
+    append is O(1) and never allocates; window() walks back from the
+    newest sample only as far as it needs to. Only the event loop touches
+    it, so there is no lock.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def window(self, seconds, now=None):
+        """Returns (times, values) of the samples from the last `seconds`, oldest first"""
+        now = time.monotonic() if now is None else now
+        cutoff = now - seconds
+        times, values = [], []
+        i = self.head
+        for _ in range(self.count):
+            i = (i - 1) % self.capacity
+            if self.times[i] < cutoff: break
+            times.append(self.times[i])
+            values.append(self.values[i])
+        times.reverse()
+        values.reverse()
+        return times, values
+
+    def stats(self, seconds, now=None):
+        """min / mean / least-squares slope (per hour) over the window"""
+        times, values = self.window(seconds, now)
+        n = len(values)
+        if n == 0: return None
+        mean = sum(values) / n
+        slope = 0.0
+        if n > 1:
+            t_mean = sum(times) / n
+            var = sum((t - t_mean) ** 2 for t in times)
+            if var > 0:
+                slope = sum((t - t_mean) * (v - mean) for t, v in zip(times, values)) / var * 3600
+        return {"min": min(values), "mean": mean, "slope_per_hour": slope, "count": n}
+
+SOIL_HISTORY = TelemetryRing(SOIL_HISTORY_SIZE)
+
+def parse_sensor_line(line):
+    """Parses 'PIR=1;SOIL_PCT=42' into [("PIR", 1), ("SOIL_PCT", 42)]"""
+    readings = []
+    for part in line.split(';'):
+        key, sep, value = part.partition('=')
+        key = key.strip()
+        if sep and key in ("PIR", "SOIL_PCT"):
+            try: readings.append((key, int(value)))
+            except ValueError: pass
+    return readings
+
+# --- FRAMING ---
+# The socket is non-blocking; every read and write is awaited on the loop.
+# A header length with the top bit set announces a binary header (type code,
+# body size and trace id in a fixed struct, then any payload as JSON); the
+# layout and type codes are the ones in brain_server.py.
+
+BINARY_FLAG = 0x80000000
+BINARY_HEADER = struct.Struct('>BI8s')
+MESSAGE_TYPES = (
+    "HELLO", "HELLO_ACK", "PIR_TRIGGER", "USER_ENTER", "SOIL_DATA", "GET_SOIL",
+    "SUBSCRIBE_SOIL", "SPEAK_INTRO", "SPEAK", "SPEAK_CHUNK", "AUDIO", "AUDIO_FRAME",
+    "AUDIO_END", "END_SESSION", "INTERRUPT", "TRACE", "GET_STATS", "STATS", "READY",
+    "ACK",
+)
+MESSAGE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES)}
+
+def encode_header(msg_type, file_size, payload=None, trace=None, binary=False):
+    if binary and msg_type in MESSAGE_CODES:
         try:
-            if not os.path.exists(SERIAL_PORT):
-                time.sleep(2)
-                continue
-            ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-            print(f">> [SENSOR] Connected to {SERIAL_PORT}")
-            while True:
-                if ser.in_waiting > 0:
-                    try:
-                        line = ser.readline().decode('utf-8', errors='ignore').strip()
-                        parts = line.split(';')
-                        for part in parts:
-                            if "PIR=" in part:
-                                latest_pir_state = int(part.split('=')[1])
-                            elif "SOIL_PCT=" in part:
-                                latest_soil_pct = int(part.split('=')[1])
-                    except: pass
-        except:
-            time.sleep(2)
-
-def send_packet(sock, msg_type, file_path=None, payload=None):
-    header = {"type": msg_type, "file_size": 0, "payload": payload or {}}
-    if file_path and os.path.exists(file_path):
-        header['file_size'] = os.path.getsize(file_path)
-    try:
-        header_bytes = json.dumps(header).encode('utf-8')
-        sock.send(struct.pack('>I', len(header_bytes)))
-        sock.send(header_bytes)
-        if header['file_size'] > 0:
-            with open(file_path, "rb") as f:
-                sock.sendall(f.read())
-    except: pass
-
-def recvall(sock, n):
-    data = b''
-    while len(data) < n:
-        chunk = sock.recv(n - len(data))
-        if not chunk: return None
-        data += chunk
-    return data
+            trace_bytes = bytes.fromhex(trace) if trace else bytes(8)
+        except ValueError:
+            trace_bytes = b""
+        if len(trace_bytes) == 8:
+            body = BINARY_HEADER.pack(MESSAGE_CODES[msg_type], file_size, trace_bytes)
+            if payload: body += json.dumps(payload).encode('utf-8')
+            return struct.pack('>I', BINARY_FLAG | len(body)) + body
+    header = {"type": msg_type, "file_size": file_size, "payload": payload or {}}
+    if trace: header['trace'] = trace
+    header_bytes = json.dumps(header).encode('utf-8')
+    return struct.pack('>I', len(header_bytes)) + header_bytes
+
+def decode_header(prefix, header_bytes):
+    if not prefix & BINARY_FLAG:
+        return json.loads(header_bytes.decode('utf-8'))
+    code, file_size, trace = BINARY_HEADER.unpack_from(header_bytes)
+    extra = header_bytes[BINARY_HEADER.size:]
+    header = {"type": MESSAGE_TYPES[code], "file_size": file_size,
+              "payload": json.loads(extra.decode('utf-8')) if extra else {}}
+    if any(trace): header['trace'] = trace.hex()
+    return header
+
+async def send_packet(sock, msg_type, payload=None, data=None, trace=None, binary=False):
+    loop = asyncio.get_running_loop()
+    await loop.sock_sendall(sock, encode_header(msg_type, len(data) if data else 0, payload, trace, binary))
+    if data:
+        await loop.sock_sendall(sock, data)
 
-def receive_packet(sock):
+async def recvall(sock, n):
+    """Reads exactly n bytes into one preallocated buffer"""
+    loop = asyncio.get_running_loop()
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        count = await loop.sock_recv_into(sock, view[got:])
+        if not count: return None
+        got += count
+    return buf
+
+async def receive_packet(sock):
+    """Reads one packet; the body (if any) ends up in header['data']"""
     try:
-        len_bytes = recvall(sock, 4)
+        len_bytes = await recvall(sock, 4)
         if not len_bytes: return None
-        header_len = struct.unpack('>I', len_bytes)[0]
-        header_bytes = recvall(sock, header_len)
+        prefix = struct.unpack('>I', len_bytes)[0]
+        header_bytes = await recvall(sock, prefix & ~BINARY_FLAG)
         if not header_bytes: return None
-        header = json.loads(header_bytes.decode('utf-8'))
-        
+        header = decode_header(prefix, header_bytes)
+
         if header.get('file_size', 0) > 0:
-            file_data = recvall(sock, header['file_size'])
-            if file_data:
-                with open("response.mp3", "wb") as f:
-                    f.write(file_data)
+            header['data'] = await recvall(sock, header['file_size'])
+            if header['data'] is None: return None
         return header
-    except: return None
+    except (OSError, ValueError, IndexError, struct.error): return None
 
-def main():
-    global is_in_session, latest_pir_state, prev_pir_state, enter_key_pressed
-    
-    threading.Thread(target=read_arduino, daemon=True).start()
-    threading.Thread(target=input_monitor, daemon=True).start()
-    
-    print(">> System Ready. Stabilizing Sensors...")
-    time.sleep(2) 
-    
-    while True:
+def save_debug_audio(path, data):
+    if DEBUG_AUDIO_FILES and data:
+        with open(path, "wb") as f:
+            f.write(data)
+
+# --- AUDIO CODECS ---
+
+# ffmpeg output arguments for each compressed upload format. Ogg pages are
+# flushed every 100 ms so a streamed Opus upload is not held back.
+ENCODER_ARGS = {
+    "opus": ["-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip",
+             "-f", "ogg", "-page_duration", "100000"],
+    "flac": ["-f", "flac"],
+}
+
+def client_codecs():
+    """What this Pi can send and play, in order of preference (the HELLO payload)"""
+    has_ffmpeg = shutil.which(FFMPEG_CMD) is not None
+    uplink = [c for c in UPLINK_CODECS if c == "pcm" or (c in ENCODER_ARGS and has_ffmpeg)]
+    downlink = [c for c in DOWNLINK_CODECS
+                if c == "mp3" or (c == "pcm" and shutil.which(PCM_PLAY_CMD[0]))]
+    # Raw PCM up and MP3 down always work; they are what the server assumes without HELLO
+    if "pcm" not in uplink: uplink.append("pcm")
+    if "mp3" not in downlink: downlink.append("mp3")
+    headers = ["binary", "json"] if BINARY_HEADERS else ["json"]
+    # "ready": hold sessions until the server says it has warmed up (READY)
+    # "resume": after a dropped connection, carry on with the same conversation
+    return {"uplink": uplink, "downlink": downlink, "headers": headers, "ready": True, "resume": True,
+            "wall_id": WALL_ID}
+
+def encoder_command(codec):
+    return [FFMPEG_CMD, "-loglevel", "error", "-f", "s16le", "-ar", str(SAMPLE_RATE), "-ac", "1",
+            "-i", "pipe:0", *ENCODER_ARGS[codec], "pipe:1"]
+
+async def encode_audio(pcm, codec):
+    """Compresses a whole recording in one go (file uploads)"""
+    proc = await asyncio.create_subprocess_exec(
+        *encoder_command(codec), stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    data, _ = await proc.communicate(pcm)
+    if proc.returncode != 0 or not data:
+        raise OSError(f"ffmpeg exited with {proc.returncode}")
+    return data
+
+class StreamEncoder:
+    """Compresses one utterance with ffmpeg while it is being recorded.
+
+    PCM frames go in through write(); encoded bytes are awaited through
+    on_data as soon as ffmpeg produces them, so the upload still streams.
+    """
+
+    def __init__(self, codec, on_data):
+        self.codec = codec
+        self.on_data = on_data
+        self.proc = None
+        self.reader = None
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            *encoder_command(self.codec), stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        self.reader = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        while True:
+            data = await self.proc.stdout.read(16 * 1024)
+            if not data: break
+            await self.on_data(data)
+
+    async def write(self, pcm):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            print(f"Connecting to {SERVER_IP}...")
-            s.connect((SERVER_IP, PORT))
-            print("Connected.")
-            last_trigger_time = 0
-            
-            while True:
-                ready, _, _ = select.select([s], [], [], 0.05)
-                if ready:
-                    msg = receive_packet(s)
-                    if not msg: break 
-                    cmd = msg['type']
-                    print(f"[CMD] {cmd}")
-                    
-                    if cmd == "SPEAK_INTRO":
-                        print(">> Playing Intro...")
-                        subprocess.call(PLAY_CMD_LIST, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                        print(">> Waiting for user to press ENTER...")
-
-                    elif cmd == "GET_SOIL":
-                        print(f">> Sending Soil Data: {latest_soil_pct}%")
-                        send_packet(s, "SOIL_DATA", payload={"soil": latest_soil_pct})
-
-                    elif cmd == "SPEAK":
-                        print(">> Playing audio...")
-                        subprocess.call(PLAY_CMD_LIST, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                        
-                        # DELETE OLD FILE & RECORD NEW
-                        if os.path.exists("input.wav"): os.remove("input.wav")
-                        print(">> Recording 10 seconds...")
-                        subprocess.call(RECORD_CMD, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                        
-                        if os.path.exists("input.wav"):
-                            print(">> Sending AUDIO...")
-                            send_packet(s, "AUDIO", file_path="input.wav")
-                        else:
-                            print(">> Error: Mic failed to record.")
-
-                    elif cmd == "END_SESSION":
-                        print(">> Session Ended.")
-                        is_in_session = False
-                        prev_pir_state = 1
-                        enter_key_pressed = False 
-
-                if enter_key_pressed:
-                    if is_in_session:
-                        print(">> Sending USER_ENTER...")
-                        send_packet(s, "USER_ENTER")
-                    enter_key_pressed = False 
-
-                current_time = time.time()
-                if not is_in_session and (current_time - last_trigger_time > PIR_COOLDOWN_SECONDS):
-                    if latest_pir_state == 1 and prev_pir_state == 0:
-                        print(f"\n>> WAVE DETECTED!")
-                        send_packet(s, "PIR_TRIGGER", payload={"soil": latest_soil_pct})
-                        is_in_session = True
-                        last_trigger_time = current_time
-                        enter_key_pressed = False 
-                    prev_pir_state = latest_pir_state
-
-                time.sleep(0.05)
-                        
+            self.proc.stdin.write(pcm)
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError): pass
+
+    async def finish(self):
+        """Flushes the encoder; everything has been handed to on_data when this returns"""
+        try: self.proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError): pass
+        await self.reader
+        await self.proc.wait()
+
+# --- AUDIO SERVICE ---
+
+class PcmPlayer:
+    """One aplay process for raw PCM replies, kept open between utterances.
+
+    A Pi Zero has nothing to decode this way. aplay does not report when a
+    buffer has been played, so play() waits for the audio's own duration.
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.rate = None
+        self.stopped = asyncio.Event()
+
+    async def play(self, data, rate):
+        if self.proc is None or self.proc.returncode is not None or rate != self.rate:
+            self.stop()
+            self.proc = await asyncio.create_subprocess_exec(
+                *PCM_PLAY_CMD, str(rate), stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            self.rate = rate
+        self.stopped.clear()
+        start = time.monotonic()
+        self.proc.stdin.write(data)
+        await self.proc.stdin.drain()
+        remaining = len(data) / (2 * rate) - (time.monotonic() - start)
+        try: await asyncio.wait_for(self.stopped.wait(), max(0.0, remaining))
+        except asyncio.TimeoutError: pass
+
+    def stop(self):
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.kill()  # Drops whatever aplay still has buffered
+        self.proc = None
+        self.stopped.set()
+
+class AudioPlayer:
+    """One mpg123 process in remote-control mode (-R) that stays running.
+
+    Playing an utterance is a LOAD command to the already-open player, so
+    there is no fork or ALSA device re-open per sentence. Streamed reply
+    chunks go through a queue and play back to back. play() only awaits
+    the player's status line, so the loop keeps serving the socket,
+    the sensors and the keyboard while audio is playing. Raw PCM replies
+    are handed to a PcmPlayer instead. on_start(meta), if set, is called
+    the moment each utterance actually starts playing.
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.pcm = PcmPlayer()
+        self.on_start = None
+        self.current_meta = None
+        self.lock = asyncio.Lock()
+        self.track_done = asyncio.Event()
+        self.track_started = False
+        self.queue = asyncio.Queue()
+        self.counter = 0
+        self.tasks = set()
+
+    async def start(self):
+        self._spawn(self._queue_worker())
+        await self._launch()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _launch(self):
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                *PLAYER_REMOTE_CMD, stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            await self._command("SILENCE")  # No per-frame progress lines
+            self._spawn(self._status_reader(self.proc))
+            print(">> [AUDIO] Player ready.")
         except Exception as e:
-            print(f"Reconnecting... {e}")
-            time.sleep(5)
+            print(f">> [AUDIO] Remote player unavailable ({e}); spawning per utterance.")
+            self.proc = None
+
+    async def _command(self, cmd):
+        self.proc.stdin.write((cmd + "\n").encode())
+        await self.proc.stdin.drain()
+
+    async def _status_reader(self, proc):
+        async for raw in proc.stdout:
+            line = raw.decode(errors='ignore')
+            if line.startswith(("@I", "@S")):
+                if not self.track_started: self._started(self.current_meta)
+                self.track_started = True
+            elif line.startswith("@P 0") and self.track_started:
+                self.track_done.set()
+            elif line.startswith("@E"):
+                print(f">> [AUDIO] Player: {line.strip()}")
+                self.track_done.set()
+        self.track_done.set()  # Player died; never leave play() hanging
+
+    def _started(self, meta):
+        if self.on_start and meta is not None: self.on_start(meta)
+
+    async def _alive(self):
+        if self.proc is not None and self.proc.returncode is not None:
+            print(">> [AUDIO] Player exited; restarting.")
+            await self._launch()
+        return self.proc is not None
+
+    async def play(self, data, meta=None):
+        """Plays one reply (MP3 unless meta says otherwise) and returns when it has finished"""
+        if not data: return
+        meta = meta or {}
+        codec = meta.get('codec', "mp3")
+        save_debug_audio(f"response.{codec}", data)
+        async with self.lock:
+            if codec == "pcm":
+                self._started(meta)
+                try: await self.pcm.play(data, int(meta.get('rate', 24000)))
+                except Exception as e: print(f">> Playback Error: {e}")
+                return
+            if not await self._alive():
+                self._started(meta)
+                await spawn_play(data)
+                return
+            self.counter += 1
+            path = os.path.join(PLAYER_TMP_DIR, f"greenwall_{os.getpid()}_{self.counter}.mp3")
+            try:
+                with open(path, "wb") as f:
+                    f.write(data)
+                self.track_started = False
+                self.current_meta = meta
+                self.track_done.clear()
+                await self._command(f"LOAD {path}")
+                await asyncio.wait_for(self.track_done.wait(), PLAYER_MAX_SECONDS)
+            except asyncio.TimeoutError:
+                print(">> [AUDIO] Player never finished the track; moving on.")
+            except Exception as e:
+                print(f">> Playback Error: {e}")
+            finally:
+                try: os.remove(path)
+                except OSError: pass
+
+    def stop(self):
+        """Stops the current utterance and drops everything queued"""
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except asyncio.QueueEmpty: break
+        if self.proc is not None and self.proc.returncode is None:
+            self._spawn(self._command("STOP"))
+        self.pcm.stop()
+        self.track_done.set()
+
+    def enqueue(self, data, meta=None):
+        self.queue.put_nowait((data, meta))
+
+    async def wait_idle(self):
+        await self.queue.join()
+
+    async def _queue_worker(self):
+        while True:
+            data, meta = await self.queue.get()
+            try: await self.play(data, meta)
+            finally: self.queue.task_done()
+
+async def spawn_play(data):
+    """Fallback: one player process for this utterance, fed through stdin"""
+    try:
+        player = await asyncio.create_subprocess_exec(
+            *PLAY_CMD_LIST, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        await player.communicate(data)
+    except Exception as e:
+        print(f">> Playback Error: {e}")
+
+class MicStream:
+    """One arecord process that keeps the capture device open.
+
+    A pump task reads fixed-size PCM frames continuously; while nobody is
+    listening they are thrown away, so a recording starts with fresh audio
+    and no process start-up delay.
+    """
+
+    def __init__(self):
+        self.frame_bytes = SAMPLE_RATE * FRAME_MS // 1000 * 2
+        self.frames = asyncio.Queue(maxsize=2 * RECORD_MAX_SECONDS * 1000 // FRAME_MS)
+        self.listening = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        while True:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *CAPTURE_CMD, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+                print(">> [AUDIO] Microphone open.")
+                while True:
+                    try: frame = await proc.stdout.readexactly(self.frame_bytes)
+                    except asyncio.IncompleteReadError: break
+                    if self.listening:
+                        try: self.frames.put_nowait(frame)
+                        except asyncio.QueueFull: pass
+                await proc.wait()
+            except Exception as e:
+                print(f">> [AUDIO] Capture Error: {e}")
+            print(">> [AUDIO] Microphone closed; reopening...")
+            await asyncio.sleep(1)
+
+    def listen(self):
+        """Starts collecting frames, discarding anything captured earlier"""
+        while True:
+            try: self.frames.get_nowait()
+            except asyncio.QueueEmpty: break
+        self.listening = True
+
+    async def read(self, timeout=1.0):
+        """Next captured frame, or None if the device stopped delivering"""
+        try: return await asyncio.wait_for(self.frames.get(), timeout)
+        except asyncio.TimeoutError: return None
+
+    def stop(self):
+        self.listening = False
+
+# --- VOICE ACTIVITY DETECTION ---
+
+def frame_features(frame):
+    """Returns (rms, zero_crossing_rate) of one S16_LE PCM frame"""
+    samples = array('h', frame)
+    if sys.byteorder == 'big': samples.byteswap()
+    n = len(samples)
+    if n == 0: return 0.0, 0.0
+    rms = math.sqrt(sum(x * x for x in samples) / n)
+    crossings = sum(1 for a, b in zip(samples, samples[1:]) if (a < 0) != (b < 0))
+    return rms, crossings / n
+
+class EnergyVAD:
+    """Energy + zero-crossing voice activity detector for one utterance.
+
+    The first frames measure the background (calibrate=False skips that
+    and keeps the fixed VAD_ENERGY_THRESHOLD).
+    """
+
+    def __init__(self, calibrate=True):
+        self.threshold = VAD_ENERGY_THRESHOLD
+        self.calibration_frames = max(1, VAD_CALIBRATION_MS // FRAME_MS) if calibrate else 0
+        self.noise = []
+        self.in_speech = False
+
+    def is_speech(self, frame):
+        rms, zcr = frame_features(frame)
+        if len(self.noise) < self.calibration_frames:
+            self.noise.append(rms)
+            if len(self.noise) == self.calibration_frames:
+                ambient = sum(self.noise) / len(self.noise)
+                self.threshold = max(VAD_ENERGY_THRESHOLD, ambient * VAD_NOISE_RATIO)
+        if rms >= self.threshold: return True
+        return self.in_speech and rms >= self.threshold / 2 and zcr >= VAD_UNVOICED_ZCR
+
+class BargeInDetector:
+    """Spots a visitor talking over the wall.
+
+    The mic also hears the wall itself, so the first BARGE_IN_CALIBRATION_MS
+    of playback only measure how loud that is (its loudest frame). After
+    that, BARGE_IN_ONSET_FRAMES frames in a row that beat it by
+    BARGE_IN_NOISE_RATIO count as the visitor speaking.
+    """
+
+    def __init__(self):
+        self.calibration_frames = BARGE_IN_CALIBRATION_MS // FRAME_MS
+        self.seen = 0
+        self.echo = 0.0
+        self.run = 0
+
+    def feed(self, frame):
+        """True once the visitor has been talking long enough"""
+        rms, _ = frame_features(frame)
+        if self.seen < self.calibration_frames:
+            self.seen += 1
+            self.echo = max(self.echo, rms)
+            return False
+        threshold = max(VAD_ENERGY_THRESHOLD, self.echo * BARGE_IN_NOISE_RATIO)
+        self.run = self.run + 1 if rms >= threshold else 0
+        return self.run >= BARGE_IN_ONSET_FRAMES
+
+def wav_bytes(frames):
+    """Wraps captured PCM frames in a WAV container, in memory"""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(b"".join(frames))
+    return buf.getvalue()
+
+async def record_with_vad(mic, on_frame, primed=None):
+    """Records from the mic until the visitor stops talking.
+
+    Every frame that belongs to the utterance (including a short pre-roll
+    before the onset) is awaited through on_frame as soon as it is captured.
+    primed holds the frames of speech that already started (barge-in); the
+    recording then continues from them without listening for an onset.
+    Returns True if speech was heard, False if the window was all silence.
+    """
+    max_frames = RECORD_MAX_SECONDS * 1000 // FRAME_MS
+    no_speech_frames = VAD_NO_SPEECH_SECONDS * 1000 // FRAME_MS
+    end_silence_frames = VAD_TRAILING_SILENCE_MS // FRAME_MS
+
+    # With the visitor already talking there is no quiet moment to calibrate on
+    vad = EnergyVAD(calibrate=not primed)
+    preroll = deque(maxlen=VAD_PREROLL_MS // FRAME_MS)
+    onset_run = 0
+    silence_run = 0
+    if primed:
+        vad.in_speech = True
+        for f in primed: await on_frame(f)
+        max_frames -= len(primed)
+    else:
+        mic.listen()
+    try:
+        for i in range(max_frames):
+            frame = await mic.read()
+            if frame is None: break
+            speech = vad.is_speech(frame)
+
+            if not vad.in_speech:
+                preroll.append(frame)
+                onset_run = onset_run + 1 if speech else 0
+                if onset_run >= VAD_ONSET_FRAMES:
+                    vad.in_speech = True
+                    for f in preroll: await on_frame(f)
+                elif i >= no_speech_frames:
+                    break
+                continue
+
+            await on_frame(frame)
+            silence_run = 0 if speech else silence_run + 1
+            if silence_run >= end_silence_frames:
+                break
+    finally:
+        mic.stop()
+    return vad.in_speech
+
+async def record_fixed(mic, primed=None):
+    """Records exactly RECORD_MAX_SECONDS of PCM frames from the open capture stream"""
+    frames = list(primed or [])
+    if not primed: mic.listen()
+    try:
+        for _ in range(RECORD_MAX_SECONDS * 1000 // FRAME_MS - len(frames)):
+            frame = await mic.read()
+            if frame is None: break
+            frames.append(frame)
+    finally:
+        mic.stop()
+    return frames
+
+# --- TRACING ---
+
+def new_trace_id():
+    return os.urandom(8).hex()
+
+class TurnTrace:
+    """Monotonic timestamps of one turn on the Pi.
+
+    The id travels in the header of every packet of the turn and comes back
+    on the server's reply; when that reply starts playing, the stage times
+    are sent to the server in a TRACE packet.
+    """
+
+    def __init__(self, kind, start=None):
+        self.id = new_trace_id()
+        self.kind = kind        # "intro" (PIR edge -> intro audio) or "turn" (visitor speaks -> reply)
+        self.marks = {"start": time.monotonic() if start is None else start}
+        self.reported = False
+
+    def mark(self, name):
+        self.marks[name] = time.monotonic()
+
+    def stages(self, playback_start):
+        """Seconds per stage, ending when the wall started to answer"""
+        m = self.marks
+        if self.kind == "intro":
+            return {"intro_response": playback_start - m["start"]}
+        stopped = m.get("record_stop", m["start"])
+        stages = {"response": playback_start - stopped}
+        if "record_stop" in m: stages["record"] = stopped - m["start"]
+        if "sent" in m and "record_stop" in m: stages["upload"] = m["sent"] - stopped
+        return stages
+
+# --- CLIENT ---
+
+class GreenWallClient:
+    """Everything the Pi does, on one asyncio event loop.
+
+    The server socket, the Arduino serial port, stdin and the audio
+    subprocesses are all awaited, so each source wakes the loop the moment
+    it has data and nothing polls. Playback and recording run as a job
+    queue next to the packet dispatcher, which keeps answering GET_SOIL and
+    forwarding ENTER while the wall is talking.
+    """
+
+    def __init__(self):
+        self.player = AudioPlayer()
+        self.mic = MicStream()
+        self.sock = None
+        self.send_lock = asyncio.Lock()
+        self.audio_jobs = asyncio.Queue()
+        self.tasks = set()
+        self.codecs = client_codecs()
+        self.uplink = "pcm"     # Until the server's HELLO_ACK says otherwise
+        self.downlink = "mp3"
+        self.binary = False     # Struct-packed headers, once HELLO_ACK agrees to them
+        self.server_ready = False   # Set by HELLO_ACK or READY once the server has warmed up
+        self.first_ready = None     # Seconds from process start to the first ready server
+        self.session_id = None      # Issued by the server; sent back in HELLO to resume
+        self.resume_token = None
+        self.received_id = 0        # Highest numbered packet received in this session
+        self.last_ack = 0           # Highest numbered packet played (acknowledged to the server)
+        self.reply_complete = None  # Set by the final SPEAK_CHUNK of the reply being played
+        self.dropped_turn = None    # Reply the visitor talked over; its late packets are ignored
+        self.trace = None           # TurnTrace of the turn waiting for its answer
+        self.player.on_start = self.on_playback_start
+
+        self.latest_pir_state = 0
+        self.latest_soil_pct = 0
+        self.in_session = False
+        self.last_trigger_time = -PIR_COOLDOWN_SECONDS
+
+        # Soil push subscription requested by the server (SUBSCRIBE_SOIL)
+        self.soil_subscription = None   # {"interval": seconds, "delta": percent} or None
+        self.last_pushed_soil = None
+        self.last_soil_push = 0.0
+        self.soil_changed = asyncio.Event()
+
+    def spawn(self, coro):
+        """Runs coro in the background, keeping a reference until it is done"""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def send(self, msg_type, payload=None, data=None, trace=None):
+        """Sends one packet; the lock keeps concurrent senders from interleaving"""
+        if self.sock is None: return
+        try:
+            async with self.send_lock:
+                await send_packet(self.sock, msg_type, payload=payload, data=data, trace=trace, binary=self.binary)
+        except OSError as e:
+            print(f">> Send Error ({msg_type}): {e}")
+
+    # --- SENSORS ---
+
+    def soil_payload(self):
+        """Latest soil reading plus its recent trend from the ring buffer"""
+        payload = {"soil": self.latest_soil_pct}
+        trend = SOIL_HISTORY.stats(SOIL_TREND_SECONDS)
+        if trend:
+            payload.update({"soil_min": trend["min"], "soil_mean": round(trend["mean"], 1),
+                            "soil_slope_per_hour": round(trend["slope_per_hour"], 2)})
+        return payload
+
+    async def ack(self, packet_id):
+        """Tells the server everything up to packet_id has been played, so it
+        will not be replayed after a reconnect"""
+        if not isinstance(packet_id, int) or packet_id <= self.last_ack: return
+        self.last_ack = packet_id
+        await self.send("ACK", payload={"id": packet_id})
+
+    def on_sensor_line(self, line):
+        now = time.monotonic()
+        for key, value in parse_sensor_line(line):
+            if key == "PIR":
+                if value == 1 and self.latest_pir_state == 0:
+                    self.spawn(self.on_pir_edge(now))
+                self.latest_pir_state = value
+            else:
+                self.latest_soil_pct = value
+                SOIL_HISTORY.append(now, value)
+                sub = self.soil_subscription
+                if sub and self.last_pushed_soil is not None and abs(value - self.last_pushed_soil) >= sub["delta"]:
+                    self.soil_changed.set()  # Significant change: push it now
+
+    async def serial_monitor(self):
+        """Feeds Arduino lines to on_sensor_line as soon as the port is readable"""
+        loop = asyncio.get_running_loop()
+        print(">> [SENSOR] Starting Arduino Listener...")
+        while True:
+            if not os.path.exists(SERIAL_PORT):
+                await asyncio.sleep(2)
+                continue
+            try:
+                ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=0)
+            except Exception as e:
+                print(f">> [SENSOR] Serial Error: {e}")
+                await asyncio.sleep(2)
+                continue
+            print(f">> [SENSOR] Connected to {SERIAL_PORT}")
+            lost = loop.create_future()
+            line_buf = bytearray()
+
+            def on_readable():
+                try:
+                    chunk = ser.read(ser.in_waiting or 1)
+                except Exception as e:
+                    if not lost.done(): lost.set_result(e)
+                    return
+                line_buf.extend(chunk)
+                while True:
+                    end = line_buf.find(b"\n")
+                    if end < 0: break
+                    line = line_buf[:end].decode('utf-8', errors='ignore').strip()
+                    del line_buf[:end + 1]
+                    self.on_sensor_line(line)
+
+            loop.add_reader(ser.fileno(), on_readable)
+            try:
+                print(f">> [SENSOR] Serial Error: {await lost}")
+            finally:
+                loop.remove_reader(ser.fileno())
+                ser.close()
+            await asyncio.sleep(2)
+
+    async def on_pir_edge(self, edge_time):
+        # Edges seen while offline or warming up, during a session or within the cooldown are dropped
+        if self.sock is None or not self.server_ready or self.in_session: return
+        if edge_time - PROCESS_START < SENSOR_SETTLE_SECONDS: return
+        if edge_time - self.last_trigger_time <= PIR_COOLDOWN_SECONDS: return
+        print(f"\n>> WAVE DETECTED!")
+        self.in_session = True
+        self.last_trigger_time = edge_time
+        self.trace = TurnTrace("intro", start=edge_time)
+        await self.send("PIR_TRIGGER", payload=self.soil_payload(), trace=self.trace.id)
+
+    # --- KEYBOARD ---
+
+    def on_stdin(self):
+        line = sys.stdin.readline()
+        if not line:
+            asyncio.get_running_loop().remove_reader(sys.stdin.fileno())
+            return
+        if self.in_session:
+            print(">> [DEBUG] Enter Captured")
+            self.spawn(self.send_enter())
+
+    async def send_enter(self):
+        # Push first so the server re-checks with fresh soil
+        if self.soil_push_due():
+            await self.push_soil()
+        print(">> Sending USER_ENTER...")
+        await self.send("USER_ENTER")
+
+    # --- SOIL PUSH ---
+
+    async def push_soil(self):
+        self.last_pushed_soil = self.latest_soil_pct
+        self.last_soil_push = time.monotonic()
+        await self.send("SOIL_DATA", payload=self.soil_payload())
+
+    def soil_push_due(self):
+        sub = self.soil_subscription
+        if not sub: return False
+        if self.last_pushed_soil is None or abs(self.latest_soil_pct - self.last_pushed_soil) >= sub["delta"]:
+            return True
+        return time.monotonic() - self.last_soil_push >= sub["interval"]
+
+    async def soil_pusher(self):
+        """Sleeps until the interval runs out or the soil changes enough"""
+        while True:
+            sub = self.soil_subscription
+            wait = max(0.0, sub["interval"] - (time.monotonic() - self.last_soil_push)) if sub else None
+            try: await asyncio.wait_for(self.soil_changed.wait(), wait)
+            except asyncio.TimeoutError: pass
+            self.soil_changed.clear()
+            if self.soil_push_due():
+                await self.push_soil()
+
+    # --- AUDIO ---
+
+    async def audio_worker(self):
+        """Plays and records in the order the server asked for"""
+        while True:
+            job = await self.audio_jobs.get()
+            try: await job()
+            except Exception as e: print(f">> Audio Error: {e}")
+
+    async def listen_for_barge_in(self):
+        """Returns the opening frames of speech heard over the wall's own voice.
+
+        The mic is left listening, so the recording carries on from them.
+        """
+        detector = BargeInDetector()
+        preroll = deque(maxlen=VAD_PREROLL_MS // FRAME_MS)
+        self.mic.listen()
+        while True:
+            frame = await self.mic.read()
+            if frame is None: continue
+            preroll.append(frame)
+            if detector.feed(frame):
+                return list(preroll)
+
+    async def play_interruptible(self, playback, turn):
+        """Awaits playback while listening for the visitor talking over it.
+
+        Returns None if it played to the end. On a barge-in, playback is
+        stopped, the server is told to drop the turn, and the frames of
+        speech heard so far are returned.
+        """
+        if not BARGE_IN:
+            await playback
+            return None
+        play_task = asyncio.ensure_future(playback)
+        listen_task = asyncio.create_task(self.listen_for_barge_in())
+        try:
+            await asyncio.wait({play_task, listen_task}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            play_task.cancel()
+            raise
+        finally:
+            listen_task.cancel()
+        if not listen_task.done() or listen_task.cancelled():
+            self.mic.stop()
+            await play_task
+            return None
+        print(">> [BARGE-IN] Visitor is talking; stopping playback.")
+        self.dropped_turn = turn
+        play_task.cancel()
+        self.player.stop()
+        await self.send("INTERRUPT", payload={"turn": turn})
+        return listen_task.result()
+
+    async def stream_utterance(self, primed=None):
+        """Sends the utterance as AUDIO_FRAME packets while it is being recorded.
+
+        With a compressed uplink the frames go through a StreamEncoder,
+        started on the first frame of speech; raw PCM is sent in batches of
+        STREAM_FRAME_MS.
+        """
+        codec = self.uplink
+        trace = self.trace
+        encoder = None
+        batch = bytearray()
+        batch_bytes = SAMPLE_RATE * STREAM_FRAME_MS // 1000 * 2
+        seq = 0
+
+        async def send_frame(data):
+            nonlocal seq
+            await self.send("AUDIO_FRAME", payload={"seq": seq, "codec": codec}, data=bytes(data), trace=trace.id)
+            seq += 1
+
+        async def on_frame(frame):
+            nonlocal encoder, codec
+            if codec != "pcm" and encoder is None:
+                encoder = StreamEncoder(codec, send_frame)
+                try: await encoder.start()
+                except OSError as e:
+                    print(f">> [CODEC] {codec} encoder unavailable ({e}); sending PCM.")
+                    encoder, codec = None, "pcm"
+            if encoder is not None:
+                await encoder.write(frame)
+                return
+            batch.extend(frame)
+            if len(batch) >= batch_bytes:
+                await send_frame(batch)
+                batch.clear()
+
+        speech = await record_with_vad(self.mic, on_frame, primed)
+        trace.mark("record_stop")
+        if encoder is not None:
+            await encoder.finish()
+        elif batch:
+            await send_frame(batch)
+        await self.send("AUDIO_END", payload={"speech": speech, "rate": SAMPLE_RATE, "codec": codec},
+                        trace=trace.id)
+        trace.mark("sent")
+        if not speech: print(">> No speech heard.")
+
+    async def encode_upload(self, frames):
+        """(body, metadata) of a whole recording in the negotiated uplink codec"""
+        if self.uplink != "pcm":
+            try:
+                data = await encode_audio(b"".join(frames), self.uplink)
+                return data, {"codec": self.uplink, "rate": SAMPLE_RATE}
+            except OSError as e:
+                print(f">> [CODEC] {self.uplink} encoding failed ({e}); sending WAV.")
+        return wav_bytes(frames), {"codec": "wav"}
+
+    async def record_and_send(self, primed=None):
+        """Records the visitor's answer and uploads it.
+
+        primed holds speech already captured by a barge-in."""
+        trace = self.trace = TurnTrace("turn")
+        if RECORD_MODE == "vad" and UPLOAD_MODE == "stream":
+            print(">> Listening (streaming)...")
+            await self.stream_utterance(primed)
+            return
+
+        if RECORD_MODE == "vad":
+            print(">> Listening...")
+            frames = []
+
+            async def collect(frame):
+                frames.append(frame)
+
+            if not await record_with_vad(self.mic, collect, primed):
+                # Nothing worth uploading; tell the server so it can re-prompt at once
+                print(">> No speech heard.")
+                await self.send("AUDIO", payload={"speech": False}, trace=trace.id)
+                return
+        else:
+            print(f">> Recording {RECORD_MAX_SECONDS} seconds...")
+            frames = await record_fixed(self.mic, primed)
+        trace.mark("record_stop")
+
+        if frames:
+            data, meta = await self.encode_upload(frames)
+            save_debug_audio(f"input.{meta['codec']}", data)
+            print(f">> Sending AUDIO ({meta['codec']}, {len(data)} bytes)...")
+            await self.send("AUDIO", payload=meta, data=data, trace=trace.id)
+            trace.mark("sent")
+        else:
+            print(">> Error: Mic failed to record.")
+
+    def on_playback_start(self, meta):
+        """First audio of the answer is playing: report how long the turn took"""
+        trace = self.trace
+        if trace is None or trace.reported or meta.get('trace') != trace.id: return
+        trace.reported = True
+        stages = trace.stages(time.monotonic())
+        print(f">> [TRACE {trace.id}] " + ", ".join(f"{k} {v * 1000:.0f}ms" for k, v in stages.items()))
+        self.spawn(self.send("TRACE", payload={"stages": stages}, trace=trace.id))
+
+    async def play_then_record(self, data, meta):
+        print(">> Playing audio...")
+        primed = await self.play_interruptible(self.player.play(data, meta), meta.get('turn'))
+        await self.ack(meta.get('id'))
+        await self.record_and_send(primed)
+
+    async def play_reply(self, turn, complete):
+        """Plays a streamed reply while its sentences arrive, then records the answer"""
+        async def playback():
+            await complete.wait()
+            print(">> Reply complete. Finishing playback...")
+            await self.player.wait_idle()
+
+        primed = await self.play_interruptible(playback(), turn)
+        if self.reply_complete is complete:
+            self.reply_complete = None  # Interrupted: the server sends no final chunk
+        await self.ack(self.received_id)  # Every chunk received so far has played or been dropped
+        await self.record_and_send(primed)
+
+    async def play_intro(self, data, meta):
+        print(">> Playing Intro...")
+        await self.player.play(data, meta)
+        await self.ack(meta.get('id'))
+        print(">> Waiting for user to press ENTER...")
+
+    # --- SERVER ---
+
+    async def handle(self, msg):
+        cmd = msg['type']
+        print(f"[CMD] {cmd}")
+        data = msg.get('data')
+        payload = msg.get('payload', {})
+        if msg.get('trace'):
+            payload['trace'] = msg['trace']  # Lets playback match the reply to its turn
+        packet_id = payload.get('id')
+        if isinstance(packet_id, int):
+            self.received_id = max(self.received_id, packet_id)
+
+        if cmd == "HELLO_ACK":
+            self.uplink = payload.get('uplink', "pcm")
+            self.downlink = payload.get('downlink', "mp3")
+            self.binary = payload.get('header') == "binary"
+            print(f">> [CODEC] Uplink {self.uplink}, downlink {self.downlink}, {payload.get('header', 'json')} headers")
+            if payload.get('resumed'):
+                print(f">> [RESUME] Session {self.session_id} resumed after packet {self.last_ack}")
+                if payload.get('listening'):
+                    self.audio_jobs.put_nowait(self.record_and_send)  # It was waiting for our answer
+            else:
+                # A fresh session: whatever was going on before the drop is over
+                self.in_session = False
+                self.last_trigger_time = -PIR_COOLDOWN_SECONDS
+                self.received_id = self.last_ack = 0
+            self.session_id = payload.get('session_id')
+            self.resume_token = payload.get('resume_token')
+            if payload.get('ready', True):  # Servers without the field are always ready
+                self.on_server_ready()
+            else:
+                print(">> Server is warming up; waiting for READY...")
+
+        elif cmd == "READY":
+            print(f">> Server warm-up: {payload.get('warmup', {})}")
+            self.on_server_ready()
+
+        elif cmd == "SPEAK_INTRO":
+            self.audio_jobs.put_nowait(lambda: self.play_intro(data, payload))
+
+        elif cmd == "GET_SOIL":
+            print(f">> Sending Soil Data: {self.latest_soil_pct}%")
+            await self.push_soil()
+
+        elif cmd == "SUBSCRIBE_SOIL":
+            self.soil_subscription = {"interval": float(payload.get('interval', 5)),
+                                      "delta": float(payload.get('delta', 2))}
+            print(f">> Pushing soil every {self.soil_subscription['interval']}s "
+                  f"or on a {self.soil_subscription['delta']}% change")
+            await self.push_soil()
+            self.soil_changed.set()  # Re-arm the pusher with the new interval
+
+        elif cmd in ("SPEAK", "SPEAK_CHUNK") and payload.get('turn') is not None \
+                and payload.get('turn') == self.dropped_turn:
+            print(">> (Dropped: the visitor talked over this reply)")
+            await self.ack(packet_id)
+
+        elif cmd == "SPEAK":
+            self.audio_jobs.put_nowait(lambda: self.play_then_record(data, payload))
+
+        elif cmd == "SPEAK_CHUNK":
+            if self.reply_complete is None:
+                # First sentence of a new reply: play it all, then record
+                self.reply_complete = asyncio.Event()
+                complete = self.reply_complete
+                self.audio_jobs.put_nowait(lambda: self.play_reply(payload.get('turn'), complete))
+            if not payload.get('final'):
+                # Queue this sentence; it plays while the next ones arrive
+                self.player.enqueue(data, payload)
+            else:
+                self.reply_complete.set()
+                self.reply_complete = None
+
+        elif cmd == "END_SESSION":
+            print(">> Session Ended.")
+            self.in_session = False
+            self.audio_jobs.put_nowait(lambda: self.ack(packet_id))  # After the goodbye has played
+
+    def on_server_ready(self):
+        if self.server_ready: return
+        self.server_ready = True
+        if self.first_ready is None:
+            self.first_ready = time.monotonic() - PROCESS_START
+            print(f">> [STARTUP] Ready for visitors {self.first_ready:.1f}s after start")
+        else:
+            print(">> Server ready.")
+
+    async def serve(self, sock):
+        """Dispatches server packets until the connection drops"""
+        self.sock = sock
+        self.soil_subscription = None
+        self.last_pushed_soil = None
+        self.uplink, self.downlink = "pcm", "mp3"
+        self.binary = False
+        self.server_ready = False
+        self.reply_complete = None
+        self.dropped_turn = None
+        workers = [self.spawn(self.soil_pusher()), self.spawn(self.audio_worker())]
+        try:
+            # Capability handshake, before anything else (including PIR_TRIGGER)
+            hello = dict(self.codecs)
+            if self.session_id:
+                hello.update({"session_id": self.session_id, "resume_token": self.resume_token,
+                              "last_id": self.last_ack})
+            await self.send("HELLO", payload=hello)
+            while True:
+                msg = await receive_packet(sock)
+                if not msg: break
+                await self.handle(msg)
+        finally:
+            self.sock = None
+            for task in workers: task.cancel()
+            while not self.audio_jobs.empty(): self.audio_jobs.get_nowait()
+            self.player.stop()
+            self.mic.stop()
+            sock.close()
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.spawn(self.serial_monitor())
+        try:
+            loop.add_reader(sys.stdin.fileno(), self.on_stdin)
+            print(">> Keyboard Ready. Press ENTER when asked.")
+        except (OSError, ValueError) as e:
+            print(f">> Keyboard unavailable: {e}")
+        await self.player.start()
+        self.mic.start()
+
+        # No fixed wait: the sensors settle while we connect (see on_pir_edge)
+        attempt = 0
+        while True:
+            self.server_ready = False
+            try:
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setblocking(False)
+                print(f"Connecting to {SERVER_IP}...")
+                try: await loop.sock_connect(s, (SERVER_IP, PORT))
+                except OSError:
+                    s.close()
+                    raise
+                print("Connected.")
+                await self.serve(s)
+                reason = "connection closed"
+            except OSError as e:
+                reason = e
+            if self.server_ready: attempt = 0  # It was working; retry quickly
+            # Exponential backoff with full jitter, so a fleet of walls does not
+            # reconnect in lockstep after a server restart
+            delay = random.uniform(0, min(RECONNECT_MAX_SECONDS, RECONNECT_BASE_SECONDS * 2 ** attempt))
+            attempt += 1
+            print(f"Reconnecting in {delay:.1f}s... ({reason})")
+            await asyncio.sleep(delay)
+
+def main():
+    try: asyncio.run(GreenWallClient().main())
+    except KeyboardInterrupt: pass
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()